@@ -0,0 +1,101 @@
+import numpy as np
+import math
+
+
+def proportion_interval(counts, total: int, z: float = 1.96):
+	"""
+		Half width of the Agresti-Coull confidence interval of binomial
+		proportions, 95% by default, which stays meaningful for proportions
+		close to 0 or 1 unlike the normal one
+	"""
+	if total == 0: return np.full(np.shape(counts), math.inf)
+	adjusted = total + z ** 2
+	p = (np.asarray(counts) + z ** 2 / 2) / adjusted
+	return z * np.sqrt(p * (1 - p) / adjusted)
+
+
+class RunningStatistics:
+	"""
+		Streaming mean and variance of vector samples with Welford's algorithm.
+		Accumulators of disjoint samples are merged with Chan's formula, so the
+		statistics can be computed by separate workers and combined afterwards.
+	"""
+
+	def __init__(self, size: int):
+		self.count = 0
+		self.mean = np.zeros(size)
+		self.squares = np.zeros(size)
+
+	def add(self, sample):
+		"""Account for a single sample in constant time"""
+		self.count += 1
+		delta = np.asarray(sample) - self.mean
+		self.mean += delta / self.count
+		self.squares += delta * (np.asarray(sample) - self.mean)
+
+	def add_batch(self, samples):
+		"""Account for a matrix of samples, one per row"""
+		samples = np.asarray(samples, dtype=float)
+		if len(samples) == 0: return
+
+		batch = RunningStatistics(len(self.mean))
+		batch.count = len(samples)
+		batch.mean = samples.mean(axis = 0)
+		batch.squares = ((samples - batch.mean) ** 2).sum(axis = 0)
+		RunningStatistics.merge(self, batch)
+
+	def merge(self, other):
+		"""Account for the samples of another accumulator"""
+		if other.count == 0: return
+
+		count = self.count + other.count
+		delta = other.mean - self.mean
+		self.mean = self.mean + delta * other.count / count
+		self.squares = self.squares + other.squares + delta ** 2 * self.count * other.count / count
+		self.count = count
+
+	def variance(self, ddof: int = 0):
+		if self.count <= ddof: return np.full_like(self.mean, math.nan)
+		return self.squares / (self.count - ddof)
+
+	def std(self, ddof: int = 0):
+		return np.sqrt(self.variance(ddof))
+
+	def confidence_interval(self, z: float = 1.96):
+		"""Half width of the normal confidence interval of the mean, 95% by default"""
+		return z * self.std(ddof = 1) / math.sqrt(self.count) if self.count > 1 else np.full_like(self.mean, math.inf)
+
+
+class FrequencyStatistics(RunningStatistics):
+	"""
+		Running statistics of the frequency of each action on paths of a fixed
+		length. The frequencies can only take time_horizon + 1 values, hence a
+		histogram of the counts is enough to compute exact quantiles.
+	"""
+
+	def __init__(self, time_horizon: int, actions: int):
+		super().__init__(actions)
+		self.time_horizon = time_horizon
+		self.histogram = np.zeros((actions, time_horizon + 1), dtype=np.int64)
+
+	def add(self, sample):
+		super().add(sample)
+		counts = np.rint(np.asarray(sample) * self.time_horizon).astype(int)
+		self.histogram[np.arange(len(counts)), counts] += 1
+
+	def add_batch(self, samples):
+		super().add_batch(samples)
+		counts = np.rint(np.asarray(samples) * self.time_horizon).astype(int)
+		for action, column in enumerate(counts.T):
+			self.histogram[action] += np.bincount(column, minlength = self.time_horizon + 1)
+
+	def merge(self, other):
+		super().merge(other)
+		self.histogram += other.histogram
+
+	def quantiles(self, levels):
+		"""Lower quantiles of the frequency of each action, one row per level"""
+		cumulative = self.histogram.cumsum(axis = 1)
+		ranks = np.ceil(np.asarray(levels, dtype=float) * self.count).clip(1, None)
+		counts = np.array([[np.searchsorted(row, rank) for row in cumulative] for rank in ranks])
+		return counts / self.time_horizon
@@ -0,0 +1,194 @@
+"""
+	Time the tree engines and a sweep on every density generator, run from the
+	madtree directory with `python benchmark.py --output baseline.json`, then
+	check later changes with `python benchmark.py --compare baseline.json`.
+	Every benchmark runs in a fresh process, so that the memory figures are
+	its own and not the ones of the benchmarks before it.
+"""
+
+from tree_generation import deltas_factory, generate_tree, update_tree, gaussian_densities, uniform_densities, \
+	constant_densities, symmetrical_densities, alternating_densities, lipschitz_densities
+from tree_search import highest_reward_leaf, path_to_leaf
+from tree_analysis import analize_actions_spread, nonzero_initializations
+from market_types import MarketTreeNode
+from tree_traversal import level_order
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import argparse, itertools, json, multiprocessing, platform, random, resource, sys, time, tracemalloc
+import numpy as np
+
+DENSITIES = [
+	gaussian_densities,
+	uniform_densities,
+	constant_densities,
+	symmetrical_densities,
+	alternating_densities,
+	lipschitz_densities
+]
+
+INITIALIZATION = (10, 10, 3)
+# Second state for the update benchmark, whose tree has another shape
+ALTERNATE_INITIALIZATION = (2, 50, 5)
+
+
+def measure(function, repeat, trace):
+	"""
+		Best wall time over the repetitions and the growth of the resident set
+		meanwhile, in KB. A further traced run gives the peak of traced memory
+		and the blocks allocated by the run still alive at its end, from two
+		tracemalloc snapshots.
+	"""
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	seconds = min(timed(function) for _ in range(repeat))
+	rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+
+	peak, blocks = None, None
+	if trace:
+		tracemalloc.start()
+		before = tracemalloc.take_snapshot()
+		result = function()
+		_, peak = tracemalloc.get_traced_memory()
+		after = tracemalloc.take_snapshot()
+		tracemalloc.stop()
+		blocks = sum(max(stat.count_diff, 0) for stat in after.compare_to(before, "filename"))
+		del result
+
+	return seconds, rss_growth, peak, blocks
+
+
+def timed(function):
+	start = time.perf_counter()
+	function()
+	return time.perf_counter() - start
+
+
+def benchmark(name, density_name, time_horizon, repeat, trace, sweep_amount, seed):
+	"""Run a single benchmark on a density and horizon, meant for a fresh process"""
+	density = next(d for d in DENSITIES if d.__name__ == density_name)
+	# Every benchmark draws the same deltas, whatever ran before it
+	random.seed(f"{seed}/{density_name}/{time_horizon}")
+	deltas = deltas_factory(time_horizon, density)
+
+	nodes = None
+	if name == "analize_actions_spread":
+		arguments = nonzero_initializations(sweep_amount)
+		description = f"{density_name} (T: {time_horizon})"
+		function = lambda: analize_actions_spread(density, arguments, time_horizon, 0, description)
+	else:
+		tree = generate_tree(time_horizon, deltas, *INITIALIZATION)
+		nodes = sum(1 for _ in level_order(tree))
+		if name == "generate_tree":
+			del tree
+			function = lambda: generate_tree(time_horizon, deltas, *INITIALIZATION)
+		elif name == "update_tree":
+			# Every update alternates between two states and delta draws, so that the tree changes shape like in a sweep
+			alternate = deltas_factory(time_horizon, density)
+			nodes = (nodes + sum(1 for _ in level_order(generate_tree(time_horizon, alternate, *ALTERNATE_INITIALIZATION)))) // 2
+			del tree
+			reused = update_tree(MarketTreeNode(1, 1, 1), time_horizon, deltas, 1, 1, 1)
+			updates = itertools.cycle([(deltas, INITIALIZATION), (alternate, ALTERNATE_INITIALIZATION)])
+
+			def function():
+				update_deltas, state = next(updates)
+				return update_tree(reused, time_horizon, update_deltas, *state)
+		elif name == "update_tree_same_shape":
+			# Updates with the state of the previous one only take the path keeping the shape
+			del tree
+			reused = update_tree(MarketTreeNode(1, 1, 1), time_horizon, deltas, *INITIALIZATION)
+			function = lambda: update_tree(reused, time_horizon, deltas, *INITIALIZATION)
+		else:
+			function = lambda: path_to_leaf(tree, highest_reward_leaf(tree))
+
+	seconds, rss_growth, peak, blocks = measure(function, repeat, trace)
+	return {
+		"benchmark": name,
+		"density": density_name,
+		"time_horizon": time_horizon,
+		"seconds": seconds,
+		"nodes": nodes,
+		"nodes_per_second": nodes / seconds if nodes is not None and seconds > 0 else None,
+		"peak_traced_bytes": peak,
+		"allocated_blocks": blocks,
+		"peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+		"rss_growth_kb": rss_growth
+	}
+
+
+def benchmark_density(density, time_horizon, repeat, trace, sweep_amount, seed):
+	"""Run every benchmark on a single density and horizon, each in a fresh process"""
+	names = ["generate_tree", "update_tree", "update_tree_same_shape", "best_path"] + (["analize_actions_spread"] if sweep_amount > 0 else [])
+
+	results = []
+	for name in names:
+		with ProcessPoolExecutor(1, mp_context = multiprocessing.get_context("spawn")) as executor:
+			results.append(executor.submit(benchmark, name, density.__name__, time_horizon, repeat, trace, sweep_amount, seed).result())
+
+	return results
+
+
+def run(horizons, densities, repeat = 3, trace = True, sweep_amount = 20, seed = 0):
+	results = []
+
+	for time_horizon in horizons:
+		for density in densities:
+			for result in benchmark_density(density, time_horizon, repeat, trace, sweep_amount, seed):
+				print(f"{result['benchmark']:>24} {result['density']:>22} T={time_horizon:<3} {result['seconds']:10.4f}s", file=sys.stderr)
+				results.append(result)
+
+	return {
+		"meta": {
+			"date": datetime.today().isoformat(),
+			"python": platform.python_version(),
+			"numpy": np.__version__,
+			"machine": platform.machine(),
+			"repeat": repeat,
+			"seed": seed
+		},
+		"results": results
+	}
+
+
+def compare(results, baseline, threshold):
+	"""List the benchmarks slower than the baseline by more than the threshold, as a fraction"""
+	key = lambda r: (r["benchmark"], r["density"], r["time_horizon"])
+	previous = {key(r): r for r in baseline["results"]}
+
+	regressions = []
+	for result in results["results"]:
+		if key(result) not in previous: continue
+		ratio = result["seconds"] / previous[key(result)]["seconds"]
+		if ratio > 1 + threshold:
+			regressions.append((*key(result), ratio))
+
+	return regressions
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark tree build, update, solve and sweep throughput")
+	parser.add_argument("--horizons", type=int, nargs=2, default=(3, 12), metavar=("FIRST", "LAST"))
+	parser.add_argument("--densities", nargs="*", default=[d.__name__ for d in DENSITIES])
+	parser.add_argument("--repeat", type=int, default=3)
+	parser.add_argument("--sweep-amount", type=int, default=20, help="initializations per group in the sweep benchmark, 0 to skip it")
+	parser.add_argument("--no-trace", action="store_true", help="skip the tracemalloc run")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--output", help="file where to write the results")
+	parser.add_argument("--compare", help="baseline results to compare against")
+	parser.add_argument("--threshold", type=float, default=0.2, help="relative slowdown reported as regression")
+	args = parser.parse_args()
+
+	densities = [d for d in DENSITIES if d.__name__ in args.densities]
+	horizons = range(args.horizons[0], args.horizons[1] + 1)
+	results = run(horizons, densities, args.repeat, not args.no_trace, args.sweep_amount, args.seed)
+
+	if args.output is not None:
+		with open(args.output, "w") as output:
+			json.dump(results, output, indent = 4)
+
+	if args.compare is not None:
+		with open(args.compare) as baseline:
+			regressions = compare(results, json.load(baseline), args.threshold)
+
+		for benchmark, density, time_horizon, ratio in regressions:
+			print(f"{benchmark} {density} T={time_horizon}: {ratio:.2f}x slower", file=sys.stderr)
+		sys.exit(1 if len(regressions) > 0 else 0)
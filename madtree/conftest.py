@@ -0,0 +1,4 @@
+# The modules import each other by name, as when run from this directory
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
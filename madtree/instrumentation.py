@@ -0,0 +1,273 @@
+"""
+	Opt-in counters and phase timers for sweeps. Nothing is patched until
+	enable() is called: phase() and label() return a shared null context and
+	the hot functions are the original ones. Once enabled, node creation and
+	recycling, feasibility checks and solver pruning are counted by wrapping
+	those functions, and every counter and timer is attributed to the current
+	density and group of init parameters.
+"""
+
+from market_types import Action, MarketTreeNode
+from tree_generation import NodePool
+import tree_solver
+
+from contextlib import contextmanager, nullcontext
+import cProfile, csv, functools, json, os, pstats, time, tracemalloc
+
+NULL_CONTEXT = nullcontext()
+
+_metrics = None
+_patches = []
+# Profile path and memory flag of the running capture, handed to the sweep workers
+_capturing = None
+# Profiler of this worker process and the process it belongs to, profiling every chunk
+_worker = None
+_worker_pid = None
+
+
+class Metrics:
+	"""Counters and phase timings keyed by name, density and group"""
+
+	def __init__(self):
+		self.density = None
+		self.group = None
+		self.counters: dict[tuple, int] = {}
+		self.timers: dict[tuple, list] = {}
+		self.captures = {}
+
+	def count(self, name: str, amount: int = 1):
+		key = (name, self.density, self.group)
+		self.counters[key] = self.counters.get(key, 0) + amount
+
+	@contextmanager
+	def phase(self, name: str):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			timer = self.timers.setdefault((name, self.density, self.group), [0, 0.])
+			timer[0] += 1
+			timer[1] += time.perf_counter() - start
+
+	@contextmanager
+	def label(self, density: str = None, group: str = None):
+		previous = self.density, self.group
+		self.density, self.group = density, group
+		try:
+			yield
+		finally:
+			self.density, self.group = previous
+
+	def merge(self, other):
+		"""Add the counters and timings of metrics collected elsewhere, for example by another process"""
+		for key, amount in other.counters.items():
+			self.counters[key] = self.counters.get(key, 0) + amount
+		for key, (calls, seconds) in other.timers.items():
+			timer = self.timers.setdefault(key, [0, 0.])
+			timer[0] += calls
+			timer[1] += seconds
+		for key, value in other.captures.items():
+			if key == "worker_profiles":
+				self.captures[key] = sorted(set(self.captures.get(key, [])) | set(value))
+			elif key == "peak_traced_bytes":
+				self.captures[key] = max(self.captures.get(key, 0), value)
+			else:
+				self.captures[key] = value
+
+	def rows(self):
+		"""One row per counter and timer, as (kind, name, density, group, count, seconds)"""
+		for (name, density, group), amount in sorted(self.counters.items(), key=str):
+			yield "counter", name, density, group, amount, None
+		for (name, density, group), (calls, seconds) in sorted(self.timers.items(), key=str):
+			yield "phase", name, density, group, calls, seconds
+
+	def export(self, path):
+		"""Write the metrics as CSV if the path ends with .csv, as JSON otherwise"""
+		columns = ("kind", "name", "density", "group", "count", "seconds")
+		with open(path, "w", newline="") as output:
+			if path.endswith(".csv"):
+				writer = csv.writer(output)
+				writer.writerow(columns)
+				writer.writerows(self.rows())
+			else:
+				json.dump({"metrics": [dict(zip(columns, row)) for row in self.rows()], "captures": self.captures}, output, indent = 4)
+
+
+def enabled() -> bool:
+	return _metrics is not None
+
+
+def metrics() -> Metrics | None:
+	"""Metrics being collected, None when disabled"""
+	return _metrics
+
+
+def phase(name: str):
+	"""Time the enclosed block as the given phase"""
+	return _metrics.phase(name) if _metrics is not None else NULL_CONTEXT
+
+
+def label(density: str = None, group: str = None):
+	"""Attribute the enclosed counters and timings to a density and group of init parameters"""
+	return _metrics.label(density, group) if _metrics is not None else NULL_CONTEXT
+
+
+def collect() -> Metrics | None:
+	"""Metrics collected so far, starting afresh, so that workers can hand them back to the main process"""
+	global _metrics
+	if _metrics is None: return None
+	collected, _metrics = _metrics, Metrics()
+	return collected
+
+
+def patch(owner, attribute, wrapper):
+	original = getattr(owner, attribute)
+	_patches.append((owner, attribute, original))
+	setattr(owner, attribute, functools.wraps(original)(wrapper(original)))
+
+
+def enable() -> Metrics:
+	"""Start collecting metrics, wrapping the hot functions"""
+	global _metrics
+	if _metrics is not None: return _metrics
+	_metrics = Metrics()
+
+	def created(original):
+		def __init__(self, *args, **kwargs):
+			_metrics.count("nodes_created")
+			original(self, *args, **kwargs)
+		return __init__
+
+	def inherited(original):
+		def inherit(self, parent, action, delta, policy = None):
+			_metrics.count("nodes_updated")
+			original(self, parent, action, delta, policy)
+		return inherit
+
+	def recycled(original):
+		def release(self, nodes):
+			_metrics.count("nodes_recycled", len(nodes))
+			original(self, nodes)
+		return release
+
+	def checked(original):
+		def can_perform(self, action, delta):
+			result = original(self, action, delta)
+			_metrics.count(f"can_perform.{action.name}")
+			if not result: _metrics.count(f"rejected.{action.name}")
+			return result
+		return can_perform
+
+	def traded(original):
+		def can_trade(inventory, cash, price, quantity, price_change):
+			result = original(inventory, cash, price, quantity, price_change)
+			_metrics.count(f"can_perform.{Action(quantity).name}")
+			if not result: _metrics.count(f"rejected.{Action(quantity).name}")
+			return result
+		return can_trade
+
+	def expanded(original):
+		def expand_level(inventory, cash, price, reward, valid, impacts):
+			level = original(inventory, cash, price, reward, valid, impacts)
+			_metrics.count("array_nodes", int(level[-1].sum()))
+			return level
+		return expand_level
+
+	patch(MarketTreeNode, "__init__", created)
+	patch(MarketTreeNode, "inherit", inherited)
+	patch(MarketTreeNode, "can_perform", checked)
+	patch(NodePool, "release", recycled)
+	patch(tree_solver, "can_trade", traded)
+	patch(tree_solver, "expand_level", expanded)
+	tree_solver.on_solve = lambda pruned: _metrics.count("pruned", pruned)
+
+	return _metrics
+
+
+def disable() -> Metrics | None:
+	"""Stop collecting metrics and restore the original functions, returns the metrics collected"""
+	global _metrics
+	while len(_patches) > 0:
+		owner, attribute, original = _patches.pop()
+		setattr(owner, attribute, original)
+	tree_solver.on_solve = None
+
+	collected, _metrics = _metrics, None
+	return collected
+
+
+def capturing() -> tuple[str | None, bool] | None:
+	"""Profile path and memory flag of the running capture, None outside of capture"""
+	return _capturing
+
+
+@contextmanager
+def capture(profile = None, memory = False):
+	"""
+		Profile the enclosed block with cProfile, writing the statistics to the
+		given path, and record the peak of memory traced by tracemalloc in the
+		captures of the metrics. Sweep workers capture their chunks as well,
+		see capture_chunk: their profiles are added to the one of this process
+		and the peak is the highest of any process.
+	"""
+	global _capturing
+	profiler = cProfile.Profile() if profile is not None else None
+	if memory: tracemalloc.start()
+	if profiler is not None: profiler.enable()
+	_capturing = (profile, memory)
+
+	try:
+		yield
+	finally:
+		_capturing = None
+		captures = _metrics.captures if _metrics is not None else {}
+		if profiler is not None:
+			profiler.disable()
+			profiler.dump_stats(profile)
+			workers = captures.pop("worker_profiles", [])
+			if len(workers) > 0:
+				stats = pstats.Stats(profile)
+				for path in workers:
+					stats.add(path)
+					os.remove(path)
+				stats.dump_stats(profile)
+			captures.update(profile = profile, profiled_workers = len(workers))
+		if memory:
+			current, peak = tracemalloc.get_traced_memory()
+			tracemalloc.stop()
+			captures.update(traced_bytes = current, peak_traced_bytes = max(peak, captures.get("peak_traced_bytes", 0)))
+
+
+@contextmanager
+def capture_chunk(capturing):
+	"""
+		Capture a chunk of a sweep in a worker, as the capture of the main
+		process says. The profile of the worker adds up over its chunks and is
+		written next to the main one, to be merged when the capture ends, and
+		tracemalloc keeps tracing between chunks, so the peak recorded is the
+		one of the worker so far.
+	"""
+	global _worker, _worker_pid
+	if capturing is None:
+		yield
+		return
+
+	profile, memory = capturing
+	if _worker_pid != os.getpid():
+		# Forked workers inherit the traces of the main process
+		_worker_pid = os.getpid()
+		_worker = cProfile.Profile() if profile is not None else None
+		if tracemalloc.is_tracing(): tracemalloc.stop()
+		if memory: tracemalloc.start()
+	if _worker is not None: _worker.enable()
+
+	try:
+		yield
+	finally:
+		if _worker is not None:
+			_worker.disable()
+			path = f"{profile}.{_worker_pid}"
+			_worker.dump_stats(path)
+			if _metrics is not None: _metrics.captures["worker_profiles"] = [path]
+		if memory and _metrics is not None:
+			_metrics.captures["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
@@ -1,33 +1,70 @@
-from tree_analysis import analize_actions_spread, nonzero_initializations, proportion_initializations
-from tree_visualization import draw_market_tree, bar_plot, stacked_bar_plot
+from tree_analysis import nonzero_initializations, proportion_initializations
 from market_types import Action, ACTIONS, MarketTreeNode
 from tree_generation import *
+from result_cache import ResultCache, CachedSolver
+from result_store import ResultWriter
+from tree_solver import solve
+from sweep import run_sweep
+import instrumentation
 
-from multiprocessing import Pool, RLock, cpu_count
-import matplotlib.pyplot as plt
 from datetime import datetime
-import os, json
-from tqdm import tqdm
-
-def analyze_density(density, arguments, destination, time_horizon, pid, description):
-	# start = time.time()
-	_, ax = plt.subplots()
-
-	frequencies, order = analize_actions_spread(density, arguments, time_horizon, pid, description)
-	frequencies_mean_t = {a.name: [r["mean"][a.name] for r in frequencies.values()] for a in ACTIONS}
-	frequencies_std_t  = {a.name: [r["std"][a.name]  for r in frequencies.values()] for a in ACTIONS}
-
-	bar_plot(ax, frequencies_mean_t, frequencies_std_t, f"{description} (T: {time_horizon})", total_width = .8, single_width = 1, labels = frequencies.keys())
-	plt.savefig(f"{destination}/{density.__name__}_{time_horizon}.pdf")
-
-	_, ax = plt.subplots()
-	stacked_bar_plot(ax, order, "Action choices over rounds")
-	plt.savefig(f"{destination}/{density.__name__}_{time_horizon}_order.pdf")
-
-	# print(f"({destination.rsplit('/', 1)[1]})", density.__name__, f"{round(time.time() - start)}s")
-	return { density.__name__: { "frequencies": frequencies, "order": order }}
+import os, json, random
+
+def analyze_densities(densities, arguments, destination, time_horizon, description, processes = None, seed = 0, cache = None,
+		precision = None, time_budget = None):
+	solver = solve if cache is None else CachedSolver(solve, cache)
+
+	# Every solved instance is streamed to disk, an interrupted run resumes from the last chunk
+	with ResultWriter(f"{destination}/records_{time_horizon}_{seed}", time_horizon) as writer:
+		results = run_sweep(densities, arguments, time_horizon, processes, seed = seed, description = description, solver = solver, writer = writer,
+			precision = precision, time_budget = time_budget)
+	if cache is not None: print(f"{description} cache {solver.cache}")
+
+	return { name: { "frequencies": frequencies, "order": order } for name, (frequencies, order) in results.items() }
+
+def sweep(destination, time_horizon, processes = None, seed = 0, cache = None, metrics = None, profile = None, memory = False,
+		precision = None, time_budget = None):
+	densities = [
+		symmetrical_densities,
+		lipschitz_densities,
+		gaussian_densities,
+		alternating_densities,
+		constant_densities,
+		uniform_densities
+	]
+
+	# Solved instances are stored across runs in the given SQLite file
+	cache = ResultCache(cache) if cache is not None else None
+
+	now = datetime.today().strftime('%Y-%m-%d-%H:%M:%S')
+
+	if not os.path.exists(f"{destination}/non-zero"): os.makedirs(f"{destination}/non-zero")
+	if not os.path.exists(f"{destination}/proportional"): os.makedirs(f"{destination}/proportional")
+
+	# With a precision or a time budget each group stops early, the amounts are upper limits.
+	# The init parameters are drawn from the seed, so that a run with the same seed resumes the stored records
+	random.seed(seed)
+	non_zero_arguments = nonzero_initializations()
+	proportional_arguments = proportion_initializations()
+
+	# Counters and phase timings are written to the metrics file, optionally with a profile of the whole sweep
+	if metrics is not None: instrumentation.enable()
+
+	try:
+		with instrumentation.capture(profile, memory) if metrics is not None else instrumentation.NULL_CONTEXT:
+			nonzero_results = analyze_densities(densities, non_zero_arguments, f"{destination}/non-zero", time_horizon, "non-zero", processes, seed, cache, precision, time_budget)
+			with open(f"{destination}/non-zero/{now}_{time_horizon}.json", "w") as nonzero:
+				nonzero.writelines(json.dumps(nonzero_results, indent = 4))
+
+			proportional_results = analyze_densities(densities, proportional_arguments, f"{destination}/proportional", time_horizon, "proportional", processes, seed, cache, precision, time_budget)
+			with open(f"{destination}/proportional/{now}_{time_horizon}.json", "w") as proportional:
+				proportional.writelines(json.dumps(proportional_results, indent = 4))
+	finally:
+		if metrics is not None: instrumentation.disable().export(metrics)
 
 if __name__ == "__main__":
+	from tree_visualization import draw_market_tree
+
 	time_horizon = 3
 
 	density = gaussian_densities
@@ -35,45 +72,5 @@ if __name__ == "__main__":
 	tree = generate_tree(time_horizon, deltas, 10, 100, 50)
 	draw_market_tree(tree, deltas, density.__name__.replace("_", " ").capitalize())
 
-	# destination = "results"
-
-	# densities = [
-	# 	symmetrical_densities,
-	# 	lipschitz_densities,
-	# 	gaussian_densities,
-	# 	alternating_densities,
-	# 	constant_densities,
-	# 	uniform_densities
-	# ]
-
-	# now = datetime.today().strftime('%Y-%m-%d-%H:%M:%S')
-
-	# if not os.path.exists(f"{destination}/non-zero"): os.makedirs(f"{destination}/non-zero")
-	# nonzero = open(f"{destination}/non-zero/{now}_{time_horizon}.json", "w")
-
-	# if not os.path.exists(f"{destination}/proportional"): os.makedirs(f"{destination}/proportional")
-	# proportional = open(f"{destination}/proportional/{now}_{time_horizon}.json", "w")
-
-	# non_zero_arguments = nonzero_initializations()
-	# proportional_arguments = proportion_initializations()
-		
-	# with Pool(cpu_count() - 1, initargs=(RLock(), ), initializer = tqdm.set_lock) as pool:
-
-	# 	nonzero_futures = [
-	# 		pool.apply_async(analyze_density,
-	# 			(density, non_zero_arguments, f"{destination}/non-zero", time_horizon, index, f"non-zero/{density.__name__}"))
-	# 		for index, density in enumerate(densities)]
-
-	# 	proportional_futures = [
-	# 		pool.apply_async(analyze_density,
-	# 			(density, proportional_arguments, f"{destination}/proportional", time_horizon, index, f"proportional/{density.__name__}"))
-	# 		for index, density in enumerate(densities, start=len(densities))]
-
-	# 	nonzero_results = [future.get() for future in nonzero_futures]
-	# 	nonzero.writelines(json.dumps({k: v for res in nonzero_results for k, v in res.items()}, indent = 4))
-
-	# 	proportional_results = [future.get() for future in proportional_futures]
-	# 	proportional.writelines(json.dumps({k: v for res in proportional_results for k, v in res.items()}, indent = 4))
-
-	# nonzero.close()
-	# proportional.close()
+	# sweep("results", time_horizon)
+	# Then draw the plots with `python render.py results`
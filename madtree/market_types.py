@@ -1,3 +1,5 @@
+from tree_traversal import level_order, visit
+
 from typing import Callable
 from enum import Enum
 import math
@@ -9,7 +11,110 @@ class Action(Enum):
 
 ACTIONS = [Action.BUY, Action.STAY, Action.SELL]
 
+# Quantities of the actions, to compare against without the Enum lookups
+BUY, STAY, SELL = (action.value for action in ACTIONS)
+
+
+def can_trade(inventory, cash, price, quantity, price_change) -> bool:
+	"""
+		Constraints of an action on a single state, shared by
+		MarketTreeNode.can_perform and the depth-first solvers. The checks
+		short-circuit, see feasible for the array version.
+	"""
+	new_price = price + price_change
+
+	if quantity == BUY:
+		preconditions = new_price <= cash
+	elif quantity == SELL:
+		preconditions = inventory > 0
+	else:
+		preconditions = quantity == STAY
+
+	return preconditions \
+		and inventory + quantity >= 0 \
+		and cash - quantity * new_price >= 0 \
+		and new_price >= 0
+
+
+def feasible(inventory, cash, price, quantity, price_change):
+	"""
+		Vectorized can_trade for the array solvers, all the arguments are
+		broadcast together.
+	"""
+	new_price = price + price_change
+
+	preconditions = (quantity == Action.STAY.value) \
+		| ((quantity == Action.BUY.value) & (new_price <= cash)) \
+		| ((quantity == Action.SELL.value) & (inventory > 0))
+
+	postconditions = (inventory + quantity >= 0) \
+		& (cash - quantity * new_price >= 0) \
+		& (new_price >= 0)
+
+	return preconditions & postconditions
+
+class Children:
+	"""
+		Dictionary-like view of the children of a node, stored in a list of
+		three slots indexed by the action value and iterated in ACTIONS order.
+	"""
+	__slots__ = ("node",)
+
+	def __init__(self, node):
+		self.node = node
+
+	def __getitem__(self, action: Action):
+		slots = self.node._children
+		child = slots[action.value] if slots is not None else None
+		if child is None: raise KeyError(action)
+		return child
+
+	def __setitem__(self, action: Action, child):
+		if self.node._children is None:
+			self.node._children = [None, None, None]
+		self.node._children[action.value] = child
+
+	def __delitem__(self, action: Action):
+		self[action]
+		self.node._children[action.value] = None
+		if self.node._children == [None, None, None]:
+			self.node._children = None
+
+	def __contains__(self, action: Action) -> bool:
+		slots = self.node._children
+		return slots is not None and slots[action.value] is not None
+
+	def get(self, action: Action, default = None):
+		slots = self.node._children
+		child = slots[action.value] if slots is not None else None
+		return default if child is None else child
+
+	def items(self):
+		slots = self.node._children
+		if slots is None: return []
+		return [(action, slots[action.value]) for action in ACTIONS if slots[action.value] is not None]
+
+	def keys(self):
+		return [action for action, _ in self.items()]
+
+	def values(self):
+		return [child for _, child in self.items()]
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self):
+		slots = self.node._children
+		return 0 if slots is None else 3 - slots.count(None)
+
+	def __repr__(self):
+		return repr(dict(self.items()))
+
+
 class MarketTreeNode:
+	# The deltas are set on a node once it has children
+	__slots__ = ("inventory", "cash", "price", "depth", "reward", "_children", "buy_delta", "sell_delta")
+
 	def __init__(self, inventory: int = 0, cash: float = 0., price: float = 0., depth: int = 0):
 		self.inventory = inventory
 		self.cash = cash
@@ -17,25 +122,36 @@ class MarketTreeNode:
 		self.depth = depth
 
 		self.reward = cash + price * inventory
-		self.children: dict[Action, MarketTreeNode] = dict()
+		self._children = None
+
+	@property
+	def children(self) -> Children:
+		"""Dictionary-like view of the children, the tree walks read the slots with child_nodes instead"""
+		return Children(self)
+
+	@children.setter
+	def children(self, children):
+		self._children = None
+		for action, child in children.items():
+			self.children[action] = child
+
+	def child_nodes(self) -> list:
+		"""Children in ACTIONS order, without going through a Children view"""
+		slots = self._children
+		if slots is None: return []
+		return [child for child in (slots[BUY], slots[STAY], slots[SELL]) if child is not None]
 
 	def can_perform(self, action: Action, delta: Callable[[int], float]) -> bool:
 		"""Check that an action can be performed on a node without breaking constraints"""
 		quantity = action.value
-		price_change = delta(quantity)
-
-		preconditions = action == Action.STAY \
-			or (action == Action.BUY and self.price + price_change <= self.cash) \
-			or (action == Action.SELL and self.inventory > 0)
+		return can_trade(self.inventory, self.cash, self.price, quantity, delta(quantity))
 
-		postconditions = self.inventory + quantity >= 0 \
-			and self.cash - quantity * (self.price + price_change) >= 0 \
-			and self.price + price_change >= 0
-		
-		return preconditions and postconditions
-
-	def inherit(self, parent, action: int, delta: Callable[[int], float]):
-		"""Update the current node to reflect the evolution of the parent node on the given action and delta"""
+	def inherit(self, parent, action: int, delta: Callable[[int], float], policy = None):
+		"""
+			Update the current node to reflect the evolution of the parent node on the
+			given action and delta. The reward is checked on every node unless a
+			ValidationPolicy says otherwise.
+		"""
 		quantity = action.value
 		price_change = delta(quantity)
 
@@ -45,19 +161,24 @@ class MarketTreeNode:
 		self.depth = parent.depth + 1
 		self.reward = parent.reward + parent.inventory * price_change
 
-		parent.buy_delta = delta(Action.BUY.value)
-		parent.sell_delta = delta(Action.SELL.value)
+		parent.buy_delta = delta(BUY)
+		parent.sell_delta = delta(SELL)
 
-		assert math.isclose(self.reward, self.cash + self.inventory * self.price), \
-			("rewards mismatch", self.reward, self.cash + self.inventory * self.price)
+		if policy is None:
+			assert math.isclose(self.reward, self.cash + self.inventory * self.price), \
+				("rewards mismatch", self.reward, self.cash + self.inventory * self.price)
+		elif policy.sample():
+			policy.check(self.reward, self.cash, self.inventory, self.price)
 
-	def perform(self, action: Action, delta: Callable[[int], float]) -> bool:
-		"""Execute an action on the tree and create the corresponding child"""
+	def perform(self, action: Action, delta: Callable[[int], float], policy = None, pool = None) -> bool:
+		"""Execute an action on the tree and create the corresponding child, taken from the pool if given"""
 		if not self.can_perform(action, delta):
 			return False
 
-		self.children[action] = MarketTreeNode()
-		self.children[action].inherit(self, action, delta)
+		child = pool.acquire() if pool is not None else MarketTreeNode()
+		if self._children is None: self._children = [None, None, None]
+		self._children[action.value] = child
+		child.inherit(self, action, delta, policy)
 		return True
 
 	def check_tree(self, deltas, time_horizon):
@@ -65,28 +186,21 @@ class MarketTreeNode:
 			Checks the given tree for consistency, making sure that all the
 			nodes are valid and that no valid nodes are missing.
 		"""
-		queue = [self]
-		
-		while len(queue) > 0:
-			node = queue.pop(0)
-			if node.depth >= time_horizon: continue
-			
-			queue.extend(node.children.values())
+		def missing_child(node):
+			if node.depth >= time_horizon: return False
+
 			delta = deltas[node.depth]
 			for action in ACTIONS:
 				if node.can_perform(action, delta) and action not in node.children:
 					print(action, node)
-					return False
+					return True
+			return False
 
-		return True
+		return visit(self, missing_child, unique=True) is None
 
 	def print_tree(self):
-		queue = [self]
-		
-		while len(queue) > 0:
-			node = queue.pop(0)
+		for node in level_order(self, unique=True):
 			print("- " * node.depth + str(node))
-			queue.extend(node.children.values())
 
 	def __str__(self):
 		return f"I {self.inventory}, C {self.cash:1.3f}, P {self.price:1.3f}, D {self.depth}, R {self.reward:1.3f}"
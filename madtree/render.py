@@ -0,0 +1,129 @@
+"""
+	Render the plots of the sweep results written by main.sweep, run from the
+	madtree directory with `python render.py results`. Every density and time
+	horizon is drawn by a pool of processes, and plots whose inputs did not
+	change since the last render are skipped.
+"""
+
+from market_types import ACTIONS
+
+from multiprocessing import Pool, cpu_count
+import argparse, glob, hashlib, json, os
+
+# File in every results directory with the hash of the inputs of each rendered plot
+STAMPS = ".render-stamps.json"
+
+# Bump to render everything again after changing how plots are drawn
+RENDER_VERSION = 1
+
+
+def latest_results(destination) -> dict[tuple[str, int], str]:
+	"""Most recent results file of every directory and time horizon, named like {date}_{T}.json"""
+	latest = {}
+	for path in sorted(glob.glob(os.path.join(destination, "**", "*_*.json"), recursive=True)):
+		name = os.path.splitext(os.path.basename(path))[0]
+		horizon = name.rsplit("_", 1)[-1]
+		if horizon.isdigit():
+			latest[(os.path.dirname(path), int(horizon))] = path
+	return latest
+
+
+def split_result(result) -> tuple[dict, list | None]:
+	"""Frequencies and order of a density, the legacy results hold the frequencies of each group directly and no order"""
+	if "frequencies" in result: return result["frequencies"], result.get("order")
+	return result, None
+
+
+def inputs_digest(task) -> str:
+	directory, density, time_horizon, description, frequencies, order = task
+	inputs = json.dumps([RENDER_VERSION, density, time_horizon, description, frequencies, order], sort_keys = True)
+	return hashlib.sha256(inputs.encode()).hexdigest()
+
+
+def outputs(task) -> list[str]:
+	directory, density, time_horizon, *_, order = task
+	paths = [f"{directory}/{density}_{time_horizon}.pdf"]
+	if order is not None: paths.append(f"{directory}/{density}_{time_horizon}_order.pdf")
+	return paths
+
+
+def plot_density(task):
+	"""Draw the frequencies and the order of the best moves of a density, if known, with figures not tied to pyplot"""
+	from tree_visualization import bar_plot, stacked_bar_plot
+	from matplotlib.figure import Figure
+
+	directory, density, time_horizon, description, frequencies, order = task
+	paths = outputs(task)
+
+	frequencies_mean_t = {a.name: [r["mean"][a.name] for r in frequencies.values()] for a in ACTIONS}
+	frequencies_std_t  = {a.name: [r["std"][a.name]  for r in frequencies.values()] for a in ACTIONS}
+
+	figure = Figure()
+	bar_plot(figure.subplots(), frequencies_mean_t, frequencies_std_t, f"{description} (T: {time_horizon})", total_width = .8, single_width = 1, labels = list(frequencies.keys()))
+	figure.savefig(paths[0])
+	figure.clear()
+	if order is None: return paths
+
+	# JSON turns the action values into strings
+	order = [{int(value): frequency for value, frequency in choices.items()} for choices in order]
+
+	figure = Figure()
+	stacked_bar_plot(figure.subplots(), order, "Action choices over rounds")
+	figure.savefig(paths[1])
+	figure.clear()
+
+	return paths
+
+
+def render(destination, processes = None, force = False) -> list[str]:
+	"""
+		Draw the plots of the latest results of every directory and time horizon
+		under the destination, skipping the ones whose inputs match the stamp of
+		the previous render unless forced. Returns the files drawn.
+	"""
+	tasks = []
+	stamps = {}
+
+	for (directory, time_horizon), path in latest_results(destination).items():
+		if directory not in stamps:
+			stamps[directory] = {}
+			if os.path.exists(os.path.join(directory, STAMPS)):
+				with open(os.path.join(directory, STAMPS)) as previous:
+					stamps[directory] = json.load(previous)
+
+		with open(path) as results:
+			for density, result in json.load(results).items():
+				description = f"{os.path.basename(directory)}/{density}"
+				task = (directory, density, time_horizon, description, *split_result(result))
+
+				key = f"{density}_{time_horizon}"
+				unchanged = stamps[directory].get(key) == inputs_digest(task) and all(os.path.exists(output) for output in outputs(task))
+				if force or not unchanged:
+					tasks.append(task)
+
+	if len(tasks) == 0: return []
+
+	processes = processes or max(min(cpu_count() - 1, len(tasks)), 1)
+	with Pool(processes) as pool:
+		drawn = pool.map(plot_density, tasks)
+
+	# Stamps are written only for the plots actually saved
+	for task in tasks:
+		directory, density, time_horizon = task[:3]
+		stamps[directory][f"{density}_{time_horizon}"] = inputs_digest(task)
+	for directory, directory_stamps in stamps.items():
+		with open(os.path.join(directory, STAMPS), "w") as output:
+			json.dump(directory_stamps, output, indent = 4, sort_keys = True)
+
+	return [path for paths in drawn for path in paths]
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Render the plots of the sweep results")
+	parser.add_argument("destination", nargs="?", default="results")
+	parser.add_argument("--processes", type=int)
+	parser.add_argument("--force", action="store_true", help="render again the plots whose inputs did not change")
+	args = parser.parse_args()
+
+	for path in render(args.destination, args.processes, args.force):
+		print(path)
@@ -0,0 +1,166 @@
+from market_types import Action
+from tree_array import price_impacts
+from tree_generation import DeltaTable
+
+from functools import partial
+from typing import Callable
+import numpy as np
+import sqlite3, time
+
+SCHEMA = """
+	CREATE TABLE IF NOT EXISTS results (
+		key TEXT PRIMARY KEY,
+		reward REAL NOT NULL,
+		actions BLOB NOT NULL,
+		used INTEGER NOT NULL
+	);
+	CREATE INDEX IF NOT EXISTS results_used ON results (used);
+"""
+
+
+def solver_name(solver: Callable) -> str:
+	"""Stable name of a solver, including the keywords of a partial, so approximate solvers get their own entries"""
+	if isinstance(solver, partial):
+		keywords = ",".join(f"{k}={v!r}" for k, v in sorted(solver.keywords.items()))
+		return f"{solver_name(solver.func)}({keywords})"
+	return f"{solver.__module__}.{solver.__qualname__}"
+
+
+class ResultCache:
+	"""
+		Persistent store of the best reward and actions of solved instances,
+		backed by SQLite. Entries are keyed by the time horizon, the initial
+		state rounded to the given precision, the digest of the delta table
+		and the name of the solver. When more than capacity entries are stored
+		the least recently used are evicted. Several processes may share the
+		same file.
+	"""
+
+	def __init__(self, path, capacity = 1_000_000, precision = 9, evict_every = 256):
+		self.path = path
+		self.capacity = capacity
+		self.precision = precision
+		self.evict_every = evict_every
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.writes = 0
+
+		self.connection = None
+
+	def connect(self):
+		if self.connection is None:
+			self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+			self.connection.execute("PRAGMA journal_mode=WAL")
+			self.connection.execute("PRAGMA synchronous=NORMAL")
+			self.connection.executescript(SCHEMA)
+		return self.connection
+
+	def close(self):
+		if self.connection is not None:
+			self.connection.close()
+			self.connection = None
+
+	def __enter__(self):
+		self.connect()
+		return self
+
+	def __exit__(self, *exception):
+		self.close()
+
+	def __getstate__(self):
+		# Connections cannot be pickled, every process opens its own
+		state = self.__dict__.copy()
+		state["connection"] = None
+		return state
+
+	def fresh(self):
+		"""Cache on the same file with zeroed counters, to hand to another process and merge back"""
+		return ResultCache(self.path, self.capacity, self.precision, self.evict_every)
+
+	def key(self, time_horizon, deltas, inventory, cash, price, solver = "") -> str:
+		table = deltas if isinstance(deltas, DeltaTable) else DeltaTable(price_impacts(deltas[:time_horizon]))
+		state = ",".join(repr(round(float(x), self.precision)) for x in (inventory, cash, price))
+		return f"{solver}|{time_horizon}|{state}|{table.digest(time_horizon)}"
+
+	def get(self, key: str) -> tuple[float, list[Action]] | None:
+		"""Stored reward and actions of the key, None if missing"""
+		connection = self.connect()
+		row = connection.execute("SELECT reward, actions FROM results WHERE key = ?", (key,)).fetchone()
+
+		if row is None:
+			self.misses += 1
+			return None
+
+		self.hits += 1
+		connection.execute("UPDATE results SET used = ? WHERE key = ?", (time.time_ns(), key))
+		reward, actions = row
+		return reward, [Action(quantity) for quantity in np.frombuffer(actions, dtype=np.int8).tolist()]
+
+	def put(self, key: str, reward: float, actions: list[Action]):
+		connection = self.connect()
+		encoded = np.array([action.value for action in actions], dtype=np.int8).tobytes()
+		connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (key, float(reward), encoded, time.time_ns()))
+
+		self.writes += 1
+		if self.writes % self.evict_every == 0:
+			self.evict()
+
+	def evict(self):
+		"""Drop the least recently used entries above the capacity"""
+		connection = self.connect()
+		excess = connection.execute("SELECT COUNT(*) FROM results").fetchone()[0] - self.capacity
+		if excess <= 0: return
+
+		connection.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY used LIMIT ?)", (excess,))
+		self.evictions += excess
+
+	def __len__(self):
+		return self.connect().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+	@property
+	def hit_rate(self) -> float:
+		lookups = self.hits + self.misses
+		return self.hits / lookups if lookups > 0 else 0.
+
+	def merge(self, other):
+		"""Add the counters of a copy of the cache used elsewhere, for example by another process"""
+		self.hits += other.hits
+		self.misses += other.misses
+		self.evictions += other.evictions
+		self.writes += other.writes
+
+	def __str__(self):
+		return f"{self.path}: hits {self.hits}, misses {self.misses}, hit rate {self.hit_rate:.1%}, evictions {self.evictions}"
+
+
+class CachedSolver:
+	"""
+		Wrapper of a solver consulting the cache before solving. Only the reward
+		and the actions are stored, so it returns the pair (reward, actions)
+		whatever the solver. It can be pickled, hence used with run_sweep.
+	"""
+
+	def __init__(self, solver: Callable, cache: ResultCache):
+		self.solver = solver
+		self.cache = cache
+		self.name = solver_name(solver)
+
+	def __call__(self, time_horizon, deltas, inventory = 0, cash = 1, price = 0, **kwargs) -> tuple[float, list[Action]]:
+		key = self.cache.key(time_horizon, deltas, inventory, cash, price, self.name)
+		result = self.cache.get(key)
+
+		if result is None:
+			result = self.solver(time_horizon, deltas, inventory, cash, price, **kwargs)[:2]
+			self.cache.put(key, *result)
+
+		return result
+
+	def fresh(self):
+		"""Solver on a fresh copy of the cache, see ResultCache.fresh"""
+		return CachedSolver(self.solver, self.cache.fresh())
+
+	def merge(self, other):
+		"""Add the counters of a copy used by another process"""
+		self.cache.merge(other.cache)
@@ -0,0 +1,170 @@
+from market_types import ACTIONS
+from tree_array import QUANTITIES
+
+import numpy as np
+import json, os, time
+
+MANIFEST = "manifest.json"
+
+
+def record_dtype(time_horizon: int) -> np.dtype:
+	"""Layout of the record of a solved instance"""
+	return np.dtype([
+		("state", "<f8", 3),
+		("impacts", "<f8", (time_horizon, len(ACTIONS))),
+		("actions", "i1", time_horizon),
+		("reward", "<f8")
+	])
+
+
+def path_rewards(states, impacts, actions) -> np.ndarray:
+	"""Reward at the end of each action path, replaying it from the initial (inventory, cash, price)"""
+	states, impacts, actions = np.asarray(states, dtype=float), np.asarray(impacts, dtype=float), np.asarray(actions)
+	inventory, cash, price = states[:, 0], states[:, 1], states[:, 2]
+
+	column = np.argmax(actions[..., np.newaxis] == QUANTITIES, axis=-1)
+	price_change = np.take_along_axis(impacts, column[..., np.newaxis], axis=-1)[..., 0]
+	held = inventory[:, np.newaxis] + np.cumsum(actions, axis=1) - actions
+	return cash + price * inventory + (held * price_change).sum(axis=1)
+
+
+def write_atomic(path, write):
+	"""Write a file through a temporary one, so readers see either the old or the new content"""
+	temporary = f"{path}.tmp"
+	with open(temporary, "wb") as file:
+		write(file)
+		file.flush()
+		os.fsync(file.fileno())
+	os.replace(temporary, path)
+
+
+class RecordBuffer:
+	"""
+		In-memory batch of solved instances grouped in units, each identified by a
+		key and tagged with the density and the group of init parameters. Buffers
+		filled by other processes can be passed to ResultWriter.extend.
+	"""
+
+	def __init__(self, time_horizon: int):
+		self.time_horizon = time_horizon
+		self.units = []
+		self.records = []
+
+	def add(self, key: str, density: str, group: str, states, impacts, actions):
+		"""Add the solved instances of a unit, one per row of each argument"""
+		states = np.asarray(states, dtype=float).reshape(-1, 3)
+		records = np.empty(len(states), dtype=record_dtype(self.time_horizon))
+		records["state"] = states
+		records["impacts"] = impacts
+		records["actions"] = actions
+		records["reward"] = path_rewards(states, impacts, actions)
+
+		self.units.append({"key": key, "density": density, "group": group, "count": len(records)})
+		self.records.append(records)
+
+	def __len__(self):
+		return sum(len(records) for records in self.records)
+
+
+class ResultWriter(RecordBuffer):
+	"""
+		Streaming store of solved instances in a directory of .npy chunks of
+		structured records, described by a manifest rewritten atomically after
+		every chunk. A unit is committed once its chunk is listed, so opening the
+		directory again resumes from the last committed chunk and the units
+		already there can be skipped.
+	"""
+
+	def __init__(self, directory, time_horizon: int, chunk_size = 100_000, flush_seconds = 60):
+		super().__init__(time_horizon)
+		self.directory = directory
+		self.chunk_size = chunk_size
+		self.flush_seconds = flush_seconds
+		self.flushed = time.monotonic()
+
+		os.makedirs(directory, exist_ok=True)
+		self.manifest = load_manifest(directory) or {"time_horizon": time_horizon, "chunks": [], "units": []}
+		assert self.manifest["time_horizon"] == time_horizon, ("time horizon mismatch", self.manifest["time_horizon"])
+		self.committed = {unit["key"]: unit for unit in self.manifest["units"]}
+
+	def __contains__(self, key: str) -> bool:
+		return key in self.committed
+
+	def committed_records(self, key: str) -> np.ndarray:
+		"""Memory-mapped records of a committed unit"""
+		unit = self.committed[key]
+		chunk = np.load(os.path.join(self.directory, unit["chunk"]), mmap_mode="r")
+		return chunk[unit["start"]:unit["stop"]]
+
+	def add(self, key: str, density: str, group: str, states, impacts, actions):
+		super().add(key, density, group, states, impacts, actions)
+		self.maybe_flush()
+
+	def extend(self, buffer: RecordBuffer):
+		self.units += buffer.units
+		self.records += buffer.records
+		self.maybe_flush()
+
+	def maybe_flush(self):
+		if len(self) >= self.chunk_size or time.monotonic() - self.flushed >= self.flush_seconds:
+			self.flush()
+
+	def flush(self):
+		"""Write the buffered units as a new chunk and commit them in the manifest"""
+		self.flushed = time.monotonic()
+		if len(self.units) == 0: return
+
+		# The units of a density and group are written next to each other, so that one slice of the chunk covers them
+		order = sorted(range(len(self.units)), key=lambda index: (self.units[index]["density"], self.units[index]["group"]))
+		name = f"chunk_{len(self.manifest['chunks']):06d}.npy"
+		records = np.concatenate([self.records[index] for index in order])
+		write_atomic(os.path.join(self.directory, name), lambda file: np.save(file, records))
+
+		start = 0
+		for unit in (self.units[index] for index in order):
+			unit = dict(unit, chunk=name, start=start, stop=start + unit["count"])
+			start = unit["stop"]
+			self.manifest["units"].append(unit)
+			self.committed[unit["key"]] = unit
+		self.manifest["chunks"].append(name)
+
+		manifest = json.dumps(self.manifest).encode()
+		write_atomic(os.path.join(self.directory, MANIFEST), lambda file: file.write(manifest))
+		self.units, self.records = [], []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exception):
+		# Completed units are kept even when the run fails
+		self.flush()
+
+
+def load_manifest(directory):
+	path = os.path.join(directory, MANIFEST)
+	if not os.path.exists(path): return None
+	with open(path) as manifest:
+		return json.load(manifest)
+
+
+def load_results(directory, density = None) -> dict[tuple[str, str], list[np.ndarray]]:
+	"""
+		Memory-mapped records of the committed units by density and group of
+		init parameters, optionally of a single density. Each group is a list of
+		slices of the chunks, one per chunk it was written to, so nothing is
+		read until used.
+	"""
+	manifest = load_manifest(directory)
+	if manifest is None: return {}
+
+	groups = {}
+	for unit in manifest["units"]:
+		if density is not None and unit["density"] != density: continue
+		parts = groups.setdefault((unit["density"], unit["group"]), [])
+		if len(parts) > 0 and parts[-1][0] == unit["chunk"] and parts[-1][2] == unit["start"]:
+			parts[-1][2] = unit["stop"]
+		else:
+			parts.append([unit["chunk"], unit["start"], unit["stop"]])
+
+	chunks = {name: np.load(os.path.join(directory, name), mmap_mode="r") for name in manifest["chunks"]}
+	return {key: [chunks[name][start:stop] for name, start, stop in parts] for key, parts in groups.items()}
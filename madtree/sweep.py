@@ -0,0 +1,164 @@
+from tree_analysis import SpreadAggregate, arguments_digest, solve_arguments
+from tree_solver import solve
+from result_store import RecordBuffer
+import instrumentation
+
+from multiprocessing import Pool, cpu_count
+import numpy as np
+import math, queue, random, time, zlib
+
+
+def chunk_seed(seed: int, *keys: str | int) -> int:
+	"""Derive the seed of a chunk from the sweep seed and the keys identifying the chunk"""
+	entropy = [seed] + [zlib.crc32(key.encode()) if isinstance(key, str) else key for key in keys]
+	return int(np.random.SeedSequence(entropy).generate_state(1)[0])
+
+
+def sweep_chunks(densities, arguments, chunk_size, seed):
+	"""Split the arguments of every density in chunks, each with its own seed"""
+	for density in densities:
+		for name, args in arguments.items():
+			for index, start in enumerate(range(0, len(args), chunk_size)):
+				yield density, name, args[start:start + chunk_size], chunk_seed(seed, density.__name__, name, index)
+
+
+def chunk_key(density, name, args, seed) -> str:
+	"""Key of a chunk in a ResultWriter, the digest of its arguments tells apart runs with other parameters or chunk sizes"""
+	return f"{density.__name__}/{name}/{seed}/{arguments_digest(args)}"
+
+
+def solve_chunk(task):
+	"""
+	Solve a chunk of arguments and return its partial aggregate, its records
+	if asked, the metrics collected meanwhile if asked to instrument and the
+	seconds it took. The chunk is profiled as the capture of the main process
+	says, if any.
+	"""
+	density, name, args, seed, time_horizon, batched, policy, solver, record, instrument, capturing = task
+	if instrument:
+		# Start from empty metrics, whatever the worker inherited from the parent
+		instrumentation.enable()
+		instrumentation.collect()
+
+	start = time.perf_counter()
+	random.seed(seed)
+	generator = np.random.default_rng(seed)
+	aggregate = SpreadAggregate(time_horizon)
+	records = RecordBuffer(time_horizon) if record else None
+
+	with instrumentation.capture_chunk(capturing), instrumentation.label(density.__name__, name):
+		actions = solve_arguments(density, args, time_horizon, batched, generator = generator, policy = policy, solver = solver,
+			writer = records, group = name, key = chunk_key(density, name, args, seed))
+		with instrumentation.phase("aggregate"):
+			aggregate.add(name, actions)
+
+	return density.__name__, aggregate, policy, solver, records, instrumentation.collect() if instrument else None, time.perf_counter() - start
+
+
+def run_sweep(densities, arguments, time_horizon, processes = None, chunk_size = 500, seed = 0, batched = False, description = None, policy = None, solver = solve,
+		writer = None, precision = None, time_budget = None):
+	"""
+	Compute the distribution of the best moves for every density and group
+	like analize_actions_spread does, spreading chunks of the init
+	parameters on a pool of processes.
+	"""
+	from tqdm.auto import tqdm
+
+	processes = processes or max(cpu_count() - 1, 1)
+	adaptive = precision is not None or time_budget is not None
+
+	# Chunks still to solve by density and group, in order
+	pending = {}
+	for chunk in sweep_chunks(densities, arguments, chunk_size, seed):
+		pending.setdefault((chunk[0], chunk[1]), []).append(chunk)
+
+	aggregates = {density.__name__: SpreadAggregate(time_horizon) for density in densities}
+	# Groups are listed in argument order, whatever order their chunks complete in
+	for density, name in pending: aggregates[density.__name__].group(name)
+	# Seconds spent solving the chunks of every density and group
+	elapsed = dict.fromkeys(pending, 0.)
+	stored = lambda density, name, args, chunk_seed: writer is not None and chunk_key(density, name, args, chunk_seed) in writer
+
+	def task(density, name, args, chunk_seed):
+		return (density, name, args, chunk_seed, time_horizon, batched, policy.fresh() if policy is not None else None, \
+			solver.fresh() if hasattr(solver, "fresh") else solver, writer is not None, instrumentation.enabled(), instrumentation.capturing())
+
+	def merge(density, name, args, chunk_seed, result):
+		"""Account for a solved chunk, or for the one stored by the writer without a result"""
+		if result is None:
+			aggregates[density.__name__].add(name, writer.committed_records(chunk_key(density, name, args, chunk_seed))["actions"])
+			return
+
+		density_name, partial, chunk_policy, chunk_solver, records, metrics, seconds = result
+		elapsed[(density, name)] += seconds
+		aggregates[density_name].merge(partial)
+		if policy is not None: policy.merge(chunk_policy)
+		if hasattr(solver, "merge"): solver.merge(chunk_solver)
+		if writer is not None: writer.extend(records)
+		if metrics is not None: instrumentation.metrics().merge(metrics)
+
+	with Pool(processes) as pool, tqdm(total = sum(len(chunks) for chunks in pending.values()), desc = description) as progress:
+		if not adaptive:
+			chunks = [chunk for group in pending.values() for chunk in group]
+			solved = pool.imap(solve_chunk, [task(*chunk) for chunk in chunks if not stored(*chunk)])
+
+			# Merge in chunk order to make the floating point sums reproducible
+			for chunk in chunks:
+				merge(*chunk, None if stored(*chunk) else next(solved))
+				progress.update(1)
+		else:
+			# Every group keeps a few chunks in flight, enough to fill the pool, and is merged in chunk order
+			in_flight = max(1, math.ceil(2 * processes / max(len(pending), 1)))
+			arrived = queue.Queue()
+			submitted, merged = dict.fromkeys(pending, 0), dict.fromkeys(pending, 0)
+			results = {key: {} for key in pending}
+			running = 0
+
+			def submit(key):
+				nonlocal running
+				chunks = pending[key]
+				while submitted[key] < len(chunks) and submitted[key] - merged[key] < in_flight:
+					index = submitted[key]
+					submitted[key] += 1
+					if stored(*chunks[index]):
+						results[key][index] = None
+						continue
+					running += 1
+					pool.apply_async(solve_chunk, (task(*chunks[index]),),
+						callback = lambda result, key = key, index = index: arrived.put((key, index, result)),
+						error_callback = lambda error: arrived.put((None, None, error)))
+
+			def advance(key):
+				"""Merge the chunks of a group arrived in order, then stop the group or submit more"""
+				(density, name), chunks = key, pending[key]
+				while True:
+					while merged[key] in results[key]:
+						merge(*chunks[merged[key]], results[key].pop(merged[key]))
+						merged[key] += 1
+						progress.update(1)
+
+						converged = precision is not None and aggregates[density.__name__].precision(name) <= precision
+						expired = time_budget is not None and elapsed[key] >= time_budget
+						if merged[key] == len(chunks) or converged or expired:
+							progress.update(len(chunks) - merged[key])
+							del pending[key]
+							return
+
+					submit(key)
+					if merged[key] not in results[key]: return
+
+			for key in list(pending):
+				advance(key)
+
+			while running > 0:
+				key, index, result = arrived.get()
+				running -= 1
+				if key is None: raise result
+				# Chunks of a group already stopped are dropped
+				if key in pending:
+					results[key][index] = result
+					advance(key)
+
+	if writer is not None: writer.flush()
+
+	return {name: (aggregate.frequencies(precision = adaptive), aggregate.normalized_order()) for name, aggregate in aggregates.items()}
@@ -0,0 +1,159 @@
+"""
+	Consistency of the solvers and of the incremental TreeUpdater against
+	the reference generate_tree and highest_reward_leaf on random instances, run from the madtree directory
+	with `python -m pytest test_solvers.py`.
+"""
+
+from market_types import ACTIONS, MarketTreeNode, feasible
+from tree_generation import NodePool, DeltaTable, density_impacts, gaussian_densities, uniform_densities, generate_tree, generate_dag
+from tree_analysis import draw_arguments_densities
+from tree_traversal import level_order
+from tree_search import highest_reward_leaf
+from tree_solver import beam_search, best_first, monte_carlo_search, solve, solve_batch
+from tree_parallel import solve_parallel
+from tree_array import ArrayMarketTree, TreeUpdater
+from result_store import ResultWriter, load_results, path_rewards
+from render import render
+
+import numpy as np
+import json, math, os, random, shutil, pytest
+
+TIME_HORIZON = 5
+AMOUNT = 20
+
+
+def random_instances(density, seed):
+	"""States, (N, T, 2) densities and (N, T, 3) price impacts of random instances"""
+	random.seed(seed)
+	generator = np.random.default_rng(seed)
+	states = np.column_stack([
+		generator.integers(0, 4, AMOUNT),
+		generator.choice([0, 0.5, 1, 10, 1000], AMOUNT) * generator.random(AMOUNT),
+		generator.choice([0, 1, 10], AMOUNT) * generator.random(AMOUNT)
+	])
+	densities = draw_arguments_densities(density, AMOUNT, TIME_HORIZON, generator)
+	return states, densities, density_impacts(densities)
+
+
+def reference(state, impacts):
+	inventory, cash, price = state
+	return highest_reward_leaf(generate_tree(TIME_HORIZON, DeltaTable(impacts), int(inventory), cash, price)).reward
+
+
+@pytest.mark.parametrize("density", [gaussian_densities, uniform_densities])
+@pytest.mark.parametrize("seed", [0, 1])
+def test_solvers_agree_with_generate_tree(density, seed):
+	states, densities, impacts = random_instances(density, seed)
+	expected = [reference(state, table) for state, table in zip(states, impacts)]
+	paths = []
+
+	for (inventory, cash, price), table, reward in zip(states.tolist(), impacts, expected):
+		inventory = int(inventory)
+		deltas = DeltaTable(table)
+
+		solved, actions = solve(TIME_HORIZON, deltas, inventory, cash, price)
+		assert math.isclose(solved, reward)
+		paths.append([action.value for action in actions])
+		assert math.isclose(best_first(TIME_HORIZON, deltas, inventory, cash, price)[0], reward)
+		replayed = path_rewards([[inventory, cash, price]], [table[:len(actions)]], [[action.value for action in actions]])[0]
+		assert math.isclose(replayed, reward)
+
+		assert math.isclose(highest_reward_leaf(generate_dag(TIME_HORIZON, deltas, inventory, cash, price)).reward, reward)
+
+		tree = ArrayMarketTree(TIME_HORIZON, deltas, inventory, cash, price)
+		assert math.isclose(tree.reward[tree.best_leaf()], reward)
+
+	actions = solve_batch(states, densities)
+	assert np.allclose(path_rewards(states, impacts, actions), expected)
+	assert np.array_equal(actions, paths)
+
+
+def test_tree_updater_agrees_with_generate_tree():
+	states, _, impacts = random_instances(uniform_densities, 3)
+	updater = TreeUpdater(MarketTreeNode(), TIME_HORIZON, pool = NodePool(capacity = 100))
+	nodes = lambda root: [(node.depth, node.inventory, node.cash, node.price, node.reward) for node in level_order(root)]
+
+	# Updating twice with each state covers the updates keeping the shape of the tree as well
+	for (inventory, cash, price), table in [instance for instance in zip(states.tolist(), impacts) for _ in range(2)]:
+		deltas = DeltaTable(table)
+		root = updater.update(deltas, int(inventory), cash, price)
+		assert nodes(root) == nodes(generate_tree(TIME_HORIZON, deltas, int(inventory), cash, price))
+		assert root.check_tree(deltas, TIME_HORIZON)
+
+	assert 0 < updater.statistics.reshaped <= AMOUNT
+
+
+def test_solve_parallel_agrees_with_generate_tree():
+	states, _, impacts = random_instances(gaussian_densities, 2)
+
+	for (inventory, cash, price), table in list(zip(states.tolist(), impacts))[:3]:
+		reward, actions = solve_parallel(TIME_HORIZON, DeltaTable(table), int(inventory), cash, price, split_depth = 2, processes = 2)
+		assert math.isclose(reward, reference((inventory, cash, price), table))
+		assert len(actions) == TIME_HORIZON
+
+
+
+
+@pytest.mark.parametrize("density", [gaussian_densities, uniform_densities])
+def test_monte_carlo_search_beats_holding_on_long_horizons(density):
+	time_horizon = 50
+	impacts = density_impacts(draw_arguments_densities(density, 2, time_horizon, np.random.default_rng(0)))
+
+	for (inventory, cash, price), table in zip([(5, 50., 10.), (1, 20., 5.)], impacts):
+		deltas = DeltaTable(table)
+		held = cash + inventory * price
+		beam, _, _ = beam_search(time_horizon, deltas, inventory, cash, price)
+		reward, actions, gap = monte_carlo_search(time_horizon, deltas, inventory, cash, price, budget = 1000, seed = 0)
+
+		assert gap is None and len(actions) == time_horizon
+		assert reward - held >= 0.75 * (beam - held) > 0
+
+def test_load_results_maps_the_groups(tmp_path):
+	states, _, impacts = random_instances(gaussian_densities, 0)
+	actions = np.zeros((AMOUNT, TIME_HORIZON), dtype=int)
+
+	# Units of two densities sharing the group names, interleaved and written in two chunks
+	with ResultWriter(tmp_path, TIME_HORIZON) as writer:
+		for unit in range(4):
+			for density in ("gaussian", "uniform"):
+				for group in ("ICP", "CP"):
+					rows = slice(unit * 5, unit * 5 + 5)
+					writer.add(f"{density}/{group}/{unit}", density, group, states[rows], impacts[rows], actions[rows])
+			if unit == 1: writer.flush()
+
+	results = load_results(tmp_path)
+	assert sorted(results) == [(density, group) for density in ("gaussian", "uniform") for group in ("CP", "ICP")]
+	for parts in results.values():
+		assert len(parts) == 2 and all(isinstance(part, np.memmap) for part in parts)
+		assert np.array_equal(np.concatenate([part["state"] for part in parts]), states)
+
+	assert list(load_results(tmp_path, "uniform")) == [("uniform", "CP"), ("uniform", "ICP")]
+
+
+def test_render_reads_legacy_results(tmp_path):
+	pytest.importorskip("matplotlib")
+	pytest.importorskip("networkx")
+
+	# The legacy results hold the frequencies of every group directly and no order
+	legacy = os.path.join(os.path.dirname(__file__), "..", "results", "non-zero", "2024-03-13-12:30:31_10.json")
+	os.makedirs(tmp_path / "non-zero")
+	shutil.copy(legacy, tmp_path / "non-zero" / "2024-03-13-12:30:31_10.json")
+	with open(legacy) as results:
+		densities = list(json.load(results))
+
+	drawn = render(str(tmp_path), processes = 1)
+	assert sorted(drawn) == sorted(str(tmp_path / "non-zero" / f"{density}_10.pdf") for density in densities)
+	assert render(str(tmp_path), processes = 1) == []
+
+def test_can_perform_matches_feasible():
+	generator = np.random.default_rng(0)
+
+	for _ in range(1000):
+		inventory, cash, price = int(generator.integers(0, 3)), float(generator.choice([0, 1]) * generator.random()), float(generator.random())
+		node = MarketTreeNode(inventory, cash, price)
+		impacts = generator.normal(0, 1, len(ACTIONS))
+
+		for action, price_change in zip(ACTIONS, impacts.tolist()):
+			allowed = node.can_perform(action, lambda quantity: price_change)
+			assert isinstance(allowed, bool)
+			assert allowed == bool(feasible(np.array([inventory]), np.array([cash]), np.array([price]), action.value, price_change)[0])
@@ -1,10 +1,15 @@
-from tree_generation import deltas_factory, generate_tree, gaussian_densities, update_tree
-from tree_visualization import highest_reward_leaf, path_to_leaf, action_path
-from market_types import ACTIONS, MarketTreeNode
+from tree_generation import BATCH_DENSITIES, DeltaTable, deltas_factory, density_impacts, draw_densities, \
+	generate_tree, gaussian_densities
+from tree_search import highest_reward_leaf, path_to_leaf, action_path
+from market_types import ACTIONS
+from tree_solver import solve, solve_batch
+from tree_array import QUANTITIES
+from accumulators import FrequencyStatistics, proportion_interval
+from result_store import load_results
+from instrumentation import phase, label
 
-from tqdm.auto import tqdm
 import numpy as np
-import random
+import hashlib, inspect, math, random, time
 
 
 def nonzero_initializations(amount = 10_000):
@@ -55,51 +60,201 @@ def proportion_initializations(amount = 5_000, precision = 11):
 	return parameters
 
 
-def analize_actions_spread(density, arguments, time_horizon, pid, description):
+def draw_arguments_densities(density, amount, time_horizon, generator = None):
+	"""
+	Draw the (amount, T, 2) alphas and betas for a set of init parameters, using the
+	batch variant of the density when one is registered. Without a generator one is
+	seeded from the random module, so that random.seed still controls the draws.
+	"""
+	if density.__name__ not in BATCH_DENSITIES:
+		return np.array([np.column_stack(density(time_horizon)) for _ in range(amount)]).reshape(amount, time_horizon, 2)
+
+	generator = generator or np.random.default_rng(random.getrandbits(64))
+	return np.stack(draw_densities(density, amount, time_horizon, generator), axis = -1)
+
+
+def gap_options(solver) -> dict:
+	"""
+	Keyword arguments turning off the optimality gap of the approximate
+	solvers, which would otherwise call solve on every instance. Solvers
+	wrapped by a CachedSolver are looked through.
+	"""
+	solver = getattr(solver, "solver", solver)
+	return {"exact_horizon": 0} if "exact_horizon" in inspect.signature(solver).parameters else {}
+
+
+def solve_arguments(density, args, time_horizon, batched = False, progress = None, generator = None, policy = None, solver = solve,
+		writer = None, group = None, key = None):
+	"""
+	Draw the market densities for each set of init parameters and find the
+	best actions, returned as a matrix with one row per set of parameters.
+	In batched mode every set of parameters is solved at once by solve_batch,
+	which is much faster but needs memory exponential in the time horizon.
+	Otherwise each set is solved by solver, solve by default or one of the
+	approximate solvers for long horizons, like beam_search, whose optimality
+	gap is turned off by gap_options. With a writer every solved instance is
+	recorded in a unit with the given key.
+	"""
+	with phase("densities"):
+		densities = draw_arguments_densities(density, len(args), time_horizon, generator)
+		impacts = density_impacts(densities)
+
+	if batched:
+		with phase("search"):
+			actions = solve_batch(args, densities, policy = policy)
+		if progress is not None: progress.update(len(args))
+	else:
+		actions = []
+		options = gap_options(solver)
+		for arg, arg_impacts in zip(args, impacts):
+			with phase("search"):
+				path = solver(time_horizon, DeltaTable(arg_impacts), *arg, policy = policy, **options)[1]
+			with phase("paths"):
+				actions.append([action.value for action in path])
+			if progress is not None: progress.update(1)
+		actions = np.array(actions).reshape(len(args), time_horizon)
+
+	if writer is not None:
+		with phase("record"):
+			writer.add(key or f"{density.__name__}/{group}", density.__name__, group, args, impacts, actions)
+
+	return actions
+
+
+class SpreadAggregate:
+	"""
+	Streaming statistics of the frequencies of the best actions for each group
+	of init parameters, plus the count of each action on every round, overall
+	and by group. Aggregates of disjoint sets of parameters can be merged.
+	"""
+
+	def __init__(self, time_horizon):
+		self.time_horizon = time_horizon
+		self.groups: dict[str, FrequencyStatistics] = {}
+		self.orders: dict[str, np.ndarray] = {}
+		self.order = np.zeros((time_horizon, len(ACTIONS)), dtype=np.int64)
+
+	def group(self, name) -> FrequencyStatistics:
+		if name not in self.groups:
+			self.groups[name] = FrequencyStatistics(self.time_horizon, len(ACTIONS))
+			self.orders[name] = np.zeros((self.time_horizon, len(ACTIONS)), dtype=np.int64)
+		return self.groups[name]
+
+	def add(self, name, actions):
+		"""Account for a matrix of best actions of the given group"""
+		# One-hot encoding of the actions, with shape (arguments, rounds, actions)
+		choices = np.asarray(actions).reshape(-1, self.time_horizon, 1) == QUANTITIES
+		self.group(name).add_batch(choices.mean(axis = 1))
+		self.orders[name] += choices.sum(axis = 0)
+		self.order += choices.sum(axis = 0)
+
+	def merge(self, other):
+		"""Account for the parameters of another aggregate"""
+		for name, statistics in other.groups.items():
+			self.group(name).merge(statistics)
+			self.orders[name] += other.orders[name]
+		self.order += other.order
+
+	def precision(self, name) -> float:
+		"""
+		Widest half width of the 95% confidence intervals of a group, among the
+		mean frequencies of the actions and the proportions of each action on
+		every round
+		"""
+		statistics = self.groups.get(name)
+		if statistics is None or statistics.count < 2: return math.inf
+		order = proportion_interval(self.orders[name], statistics.count)
+		return float(max(statistics.confidence_interval().max(), order.max()))
+
+	def frequencies(self, quantiles = None, confidence = False, precision = False):
+		"""
+		Mean and standard deviation of the frequency of each action on the best
+		paths, by group. Optionally add the given quantiles, the half width of
+		the 95% confidence interval of the mean, and the precision reached
+		along with the number of samples.
+		"""
+		frequencies = {}
+
+		for name, statistics in self.groups.items():
+			frequencies[name] = {
+				"mean": {a.name: float(r) for a, r in zip(ACTIONS, statistics.mean)},
+				"std":  {a.name: float(r) for a, r in zip(ACTIONS, statistics.std())}
+			}
+
+			if quantiles is not None:
+				frequencies[name]["quantiles"] = {
+					str(level): {a.name: float(r) for a, r in zip(ACTIONS, row)}
+					for level, row in zip(quantiles, statistics.quantiles(quantiles))
+				}
+
+			if confidence:
+				frequencies[name]["ci"] = {a.name: float(r) for a, r in zip(ACTIONS, statistics.confidence_interval())}
+
+			if precision:
+				frequencies[name]["samples"] = statistics.count
+				frequencies[name]["precision"] = self.precision(name)
+
+		return frequencies
+
+	def normalized_order(self):
+		"""Frequency of each action on every round of the best paths"""
+		total_arguments = sum(statistics.count for statistics in self.groups.values())
+		return [{action.value: count / total_arguments for action, count in zip(ACTIONS, counts.tolist())} \
+			for counts in self.order]
+
+
+def arguments_digest(args) -> str:
+	"""Short digest of a list of init parameters, so that stored results are only reused for the same ones"""
+	return hashlib.sha256(np.asarray(args, dtype=float).tobytes()).hexdigest()[:16]
+
+
+def analize_actions_spread(density, arguments, time_horizon, pid, description, batched = False, policy = None, solver = solve, writer = None,
+		precision = None, time_budget = None, batch = 500):
 	"""
 	Using the init parameters compute the distribution of the best moves
 	on the best path reward-wise and extract mean and variance.
 	"""
-	tree = MarketTreeNode(1, 1, 1)
-	frequencies = {}
-	order = [{action: 0 for action in ACTIONS} for _ in range(time_horizon)]
+	from tqdm.auto import tqdm
+
+	aggregate = SpreadAggregate(time_horizon)
+	adaptive = precision is not None or time_budget is not None
 
 	total_arguments = sum(len(args) for args in arguments.values())
 	with tqdm(total = total_arguments, desc = description, position = pid) as progress:
-		
 		for name, args in arguments.items():
-			actions_count = []
-
-			for arg in args:
-				deltas = deltas_factory(time_horizon, density)
-				tree = update_tree(tree, time_horizon, deltas, *arg)
-				path = path_to_leaf(tree, highest_reward_leaf(tree))
-				actions = action_path(path)
+			start = time.perf_counter()
 
-				for index, action in enumerate(actions):
-					order[index][action] += 1
+			for first in range(0, len(args), batch if adaptive else max(len(args), 1)):
+				batch_args = args[first:first + batch] if adaptive else args
+				key = f"{density.__name__}/{name}/{first}/{arguments_digest(batch_args)}" if adaptive else f"{density.__name__}/{name}/{arguments_digest(args)}"
 
-				actions_count.append({
-					action: actions.count(action) / len(actions) 
-					for action in ACTIONS
-				})
+				if writer is not None and key in writer:
+					aggregate.add(name, writer.committed_records(key)["actions"])
+					progress.update(len(batch_args))
+				else:
+					with label(density.__name__, name):
+						actions = solve_arguments(density, batch_args, time_horizon, batched, progress, policy = policy, solver = solver,
+							writer = writer, group = name, key = key)
+						with phase("aggregate"):
+							aggregate.add(name, actions)
 
-				progress.update(1)
+				if precision is not None and aggregate.precision(name) <= precision: break
+				if time_budget is not None and time.perf_counter() - start >= time_budget: break
 
-			frequencies_mean = avg_dict(actions_count, ACTIONS)
-			frequencies_std = std_dict(actions_count, frequencies_mean, ACTIONS)
+			# Account for the skipped arguments in the progress bar
+			progress.update(len(args) - (aggregate.groups[name].count if name in aggregate.groups else 0))
 
-			frequencies[name] = {
-				"mean": {a.name: r for a, r in frequencies_mean.items()},
-				"std":  {a.name: r for a, r in frequencies_std.items()}
-			}
+	if writer is not None: writer.flush()
+	return aggregate.frequencies(precision = adaptive), aggregate.normalized_order()
 
-	# Normalize count over total arguments
-	for index in range(time_horizon):
-		order[index] = {action.value: count / total_arguments  \
-				  for action, count in order[index].items()}
 
-	return frequencies, order
+def stored_actions_spread(directory, density, time_horizon):
+	"""Frequencies and order of the best moves of the instances recorded by a ResultWriter, without solving them again"""
+	aggregate = SpreadAggregate(time_horizon)
+	for (_, name), parts in load_results(directory, density.__name__).items():
+		for records in parts:
+			aggregate.add(name, records["actions"])
+	return aggregate.frequencies(), aggregate.normalized_order()
 
 
 def avg_dict(dicts, keys):
@@ -107,7 +262,7 @@ def avg_dict(dicts, keys):
 
 
 def std_dict(dicts, means, keys):
-	return {k: np.sqrt(sum((d[k] - means[k]) ** 2 for d in dicts)) / len(dicts) for k in keys}
+	return {k: np.sqrt(sum((d[k] - means[k]) ** 2 for d in dicts) / len(dicts)) for k in keys}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,351 @@
+from market_types import Action, ACTIONS, MarketTreeNode, feasible
+from tree_generation import DeltaTable, NodePool, UpdateStatistics
+from validation import ValidationPolicy
+
+from typing import Callable
+import numpy as np
+
+# Quantities in the same order as ACTIONS, the k-th child of a node is reached with ACTIONS[k]
+QUANTITIES = np.array([action.value for action in ACTIONS])
+
+
+def price_impacts(deltas: list[Callable[[int], float]]) -> np.ndarray:
+	"""Evaluate every delta on every action, one row per round with columns in ACTIONS order"""
+	if isinstance(deltas, DeltaTable):
+		return deltas.impacts
+	return np.array([[delta(action.value) for action in ACTIONS] for delta in deltas], dtype=float).reshape(-1, len(ACTIONS))
+
+
+def expand_level(inventory, cash, price, reward, valid, impacts):
+	"""
+		Vectorized MarketTreeNode.perform over a whole level. The nodes lie on
+		the last axis, impacts has shape (..., 3) and holds the price changes of
+		the round. The k-th child of the i-th node ends up in position 3i + k.
+	"""
+	quantity = QUANTITIES
+	price_change = np.asarray(impacts)[..., np.newaxis, :]
+	inventory, cash, price, reward, valid = (a[..., np.newaxis] for a in (inventory, cash, price, reward, valid))
+
+	child_valid = valid & feasible(inventory, cash, price, quantity, price_change)
+	child_price = price + price_change
+	child_inventory = inventory + quantity
+	child_cash = cash - quantity * child_price
+	child_reward = reward + inventory * price_change
+
+	flat = lambda a: np.broadcast_to(a, child_valid.shape).reshape(*child_valid.shape[:-2], -1)
+	return tuple(flat(a) for a in (child_inventory, child_cash, child_price, child_reward, child_valid))
+
+
+class ArrayMarketTree:
+	"""
+		Market tree stored level by level in flat arrays using a ternary layout,
+		the nodes of depth d occupy the 3^d entries starting at level_offset(d).
+		Entries not reachable under the constraints are kept but masked out.
+	"""
+
+	def __init__(self, time_horizon, deltas, inventory = 0, cash = 1, price = 0, policy = None):
+		self.time_horizon = time_horizon
+		self.impacts = price_impacts(deltas[:time_horizon])
+
+		size = self.level_offset(time_horizon + 1)
+		self.inventory = np.empty(size, dtype=np.result_type(inventory, np.int64))
+		self.cash = np.empty(size)
+		self.price = np.empty(size)
+		self.reward = np.empty(size)
+		self.depth = np.empty(size, dtype=np.uint8)
+		self.valid = np.zeros(size, dtype=bool)
+
+		self.inventory[0], self.cash[0], self.price[0] = inventory, cash, price
+		self.reward[0] = cash + price * inventory
+		self.depth[0] = 0
+		self.valid[0] = True
+
+		self.expand_levels(0, time_horizon)
+		self.validate(policy)
+
+	def expand_levels(self, first, last):
+		"""Fill the levels from first + 1 to last expanding the nodes of the previous one"""
+		for depth in range(first, last):
+			parents, children = self.level(depth), self.level(depth + 1)
+			level = expand_level(self.inventory[parents], self.cash[parents], self.price[parents],
+				self.reward[parents], self.valid[parents], self.impacts[depth])
+
+			for field, values in zip((self.inventory, self.cash, self.price, self.reward, self.valid), level):
+				field[children] = values
+			self.depth[children] = depth + 1
+
+	def extend(self, deltas, policy = None):
+		"""
+			Grow the tree by one round per delta, expanding only the current
+			leaves. Only the new levels are validated.
+		"""
+		impacts = price_impacts(deltas)
+		first, last = self.time_horizon, self.time_horizon + len(impacts)
+		extra = self.level_offset(last + 1) - self.level_offset(first + 1)
+
+		grow = lambda a: np.concatenate([a, np.zeros(extra, dtype=a.dtype)])
+		self.inventory, self.cash, self.price, self.reward, self.depth, self.valid = \
+			(grow(a) for a in (self.inventory, self.cash, self.price, self.reward, self.depth, self.valid))
+		self.impacts = np.concatenate([self.impacts, impacts])
+		self.time_horizon = last
+
+		self.expand_levels(first, last)
+		self.validate(policy, first + 1)
+		return self
+
+	@staticmethod
+	def level_offset(depth: int) -> int:
+		"""Index of the first node of the given depth"""
+		return (3 ** depth - 1) // 2
+
+	def level(self, depth: int) -> slice:
+		"""Slice of the arrays holding the nodes of the given depth"""
+		return slice(self.level_offset(depth), self.level_offset(depth + 1))
+
+	def __len__(self):
+		"""Number of valid nodes in the tree"""
+		return int(self.valid.sum())
+
+	def child(self, index: int, action: Action) -> int:
+		"""Index of the child of the given node reached through the action"""
+		return 3 * index + 1 + ACTIONS.index(action)
+
+	def parent(self, index: int) -> int:
+		"""Index of the parent of the given node"""
+		return (index - 1) // 3
+
+	def validate(self, policy = None, first_depth = 0):
+		"""Check the reward of every valid node from the given depth at once, reporting all the mismatches"""
+		policy = policy or ValidationPolicy("deferred")
+		policy.begin_tree()
+		nodes = slice(self.level_offset(first_depth), None)
+		policy.check_arrays(self.reward[nodes], self.cash[nodes], self.inventory[nodes], self.price[nodes], self.valid[nodes])
+
+	def leaves(self, time_horizon = None) -> np.ndarray:
+		"""Indices of the valid nodes without valid children, in level order, of the tree cut at the given horizon"""
+		time_horizon = self.time_horizon if time_horizon is None else time_horizon
+		end = self.level_offset(time_horizon + 1)
+		leaf = self.valid[:end].copy()
+		inner = slice(0, self.level_offset(time_horizon))
+		leaf[inner] &= ~self.valid[1:end].reshape(-1, 3).any(axis=1)
+		return np.flatnonzero(leaf)
+
+	def best_leaf(self, time_horizon = None) -> int:
+		"""Index of the first leaf in level order with the highest reward, of the tree cut at the given horizon"""
+		leaves = self.leaves(time_horizon)
+		return int(leaves[np.argmax(self.reward[leaves])])
+
+	def best_paths(self, first = 1) -> dict[int, tuple[float, list[Action]]]:
+		"""Highest reward and actions leading to it for every horizon from first to the one of the tree"""
+		paths = {}
+		for time_horizon in range(first, self.time_horizon + 1):
+			best = self.best_leaf(time_horizon)
+			paths[time_horizon] = self.reward[best].item(), self.action_path(best)
+		return paths
+
+	def path_to(self, index: int) -> list[int]:
+		"""Indices of the nodes from the root to the given node"""
+		path = [index]
+		while path[-1] != 0:
+			path.append(self.parent(path[-1]))
+		return path[::-1]
+
+	def action_path(self, index: int) -> list[Action]:
+		"""Actions performed from the root to reach the given node"""
+		return [ACTIONS[(node - 1) % 3] for node in self.path_to(index)[1:]]
+
+	def node(self, index: int):
+		"""View of a single node compatible with MarketTreeNode"""
+		return ArrayNodeView(self, index)
+
+	@property
+	def root(self):
+		return self.node(0)
+
+
+class ArrayNodeView:
+	"""Read-only MarketTreeNode look-alike backed by an ArrayMarketTree entry"""
+
+	def __init__(self, tree: ArrayMarketTree, index: int):
+		self.tree = tree
+		self.index = index
+
+	inventory = property(lambda self: self.tree.inventory[self.index].item())
+	cash = property(lambda self: self.tree.cash[self.index].item())
+	price = property(lambda self: self.tree.price[self.index].item())
+	reward = property(lambda self: self.tree.reward[self.index].item())
+	depth = property(lambda self: self.tree.depth[self.index].item())
+
+	@property
+	def children(self) -> dict[Action, "ArrayNodeView"]:
+		if self.depth >= self.tree.time_horizon:
+			return dict()
+
+		children = {action: self.tree.child(self.index, action) for action in ACTIONS}
+		return {action: self.tree.node(child) for action, child in children.items() if self.tree.valid[child]}
+
+	def child_nodes(self) -> list["ArrayNodeView"]:
+		return list(self.children.values())
+
+	@property
+	def buy_delta(self) -> float:
+		if len(self.children) == 0: raise AttributeError("buy_delta")
+		return self.tree.impacts[self.depth, ACTIONS.index(Action.BUY)].item()
+
+	@property
+	def sell_delta(self) -> float:
+		if len(self.children) == 0: raise AttributeError("sell_delta")
+		return self.tree.impacts[self.depth, ACTIONS.index(Action.SELL)].item()
+
+	def __eq__(self, other):
+		return isinstance(other, ArrayNodeView) and self.tree is other.tree and self.index == other.index
+
+	def __hash__(self):
+		return hash((id(self.tree), self.index))
+
+	can_perform = MarketTreeNode.can_perform
+	check_tree = MarketTreeNode.check_tree
+	print_tree = MarketTreeNode.print_tree
+	__str__ = MarketTreeNode.__str__
+
+
+def generate_array_tree(time_horizon, deltas, inventory = 0, cash = 1, price = 0, policy = None) -> ArrayNodeView:
+	"""Array-backed generate_tree, returns a view of the root usable wherever a MarketTreeNode is"""
+	return ArrayMarketTree(time_horizon, deltas, inventory, cash, price, policy).root
+
+
+class TreeUpdater:
+	"""
+		Incremental version of update_tree for a tree updated many times. The
+		nodes are kept level by level, each with its slot in the ternary
+		layout of ArrayMarketTree: 3 times the position of the parent in the
+		previous level plus the index of the action. An update expands every
+		level at once with expand_level and writes the values back to the
+		nodes in a single pass. Only the edges whose feasibility changed are
+		patched: the nodes below an edge that became infeasible are released
+		to the pool level by level, and the nodes of a new edge are taken from
+		it, so no node goes through can_perform or inherit.
+	"""
+
+	def __init__(self, root, time_horizon, policy = None, pool = None):
+		self.root = root
+		self.time_horizon = time_horizon
+		self.policy = policy
+		self.pool = pool if pool is not None else NodePool()
+		self.statistics = UpdateStatistics()
+
+		self.levels: list[list[MarketTreeNode]] = [[root]]
+		self.slots: list[np.ndarray] = [np.zeros(1, dtype=np.intp)]
+
+		for depth in range(time_horizon):
+			nodes, slots = [], []
+			for position, node in enumerate(self.levels[depth]):
+				if node._children is None: continue
+				for index, action in enumerate(ACTIONS):
+					child = node._children[action.value]
+					if child is not None:
+						nodes.append(child)
+						slots.append(3 * position + index)
+			self.levels.append(nodes)
+			self.slots.append(np.array(slots, dtype=np.intp))
+
+		# Nodes beyond the horizon are not updated, recycle them
+		for node in self.levels[time_horizon]:
+			if node._children is not None:
+				for child in node.child_nodes():
+					self.statistics.recycle(child, self.pool)
+				node._children = None
+
+	def update(self, deltas, inventory, cash, price):
+		"""Update the tree to reflect the new parameters and deltas"""
+		impacts = price_impacts(deltas[:self.time_horizon])
+		buy, sell = ACTIONS.index(Action.BUY), ACTIONS.index(Action.SELL)
+		validator = self.policy or ValidationPolicy("deferred")
+		validator.begin_tree()
+
+		root = self.root
+		root.inventory, root.cash, root.price = inventory, cash, price
+		root.reward = cash + price * inventory
+		level = (np.array([inventory]), np.array([cash], dtype=float), np.array([price], dtype=float), np.array([root.reward]))
+
+		# New position of each node of the previous level, -1 if removed, None if the level did not change
+		remap = None
+		reshaped = False
+
+		for depth in range(self.time_horizon):
+			parents, nodes, slots = self.levels[depth], self.levels[depth + 1], self.slots[depth + 1]
+			if depth == 0:
+				root.buy_delta, root.sell_delta = impacts[0, buy].item(), impacts[0, sell].item()
+
+			*candidates, feasible_children = expand_level(*level, np.ones(len(parents), dtype=bool), impacts[depth])
+			if remap is not None:
+				slots = 3 * remap[slots // 3] + slots % 3
+
+			# Nodes whose parent was removed have negative slots
+			kept = slots >= 0
+			kept[kept] = feasible_children[slots[kept]]
+			present = np.zeros(len(feasible_children), dtype=bool)
+			present[slots[kept]] = True
+			added = np.flatnonzero(feasible_children & ~present)
+
+			if kept.all() and len(added) == 0:
+				remap = None
+			else:
+				reshaped = True
+				nodes, slots, remap = self.patch(depth, parents, nodes, slots, kept, added)
+			self.levels[depth + 1], self.slots[depth + 1] = nodes, slots
+
+			level = tuple(a[slots] for a in candidates)
+			inventory, cash, price, reward = level
+			validator.check_arrays(reward, cash, inventory, price)
+			self.statistics.reused += int(kept.sum())
+
+			columns = zip(nodes, inventory.tolist(), cash.tolist(), price.tolist(), reward.tolist())
+			if depth + 1 == self.time_horizon:
+				for node, node_inventory, node_cash, node_price, node_reward in columns:
+					node.inventory, node.cash, node.price, node.reward = node_inventory, node_cash, node_price, node_reward
+			else:
+				# STAY is always feasible, so every node above the horizon has children and their deltas
+				buy_delta, sell_delta = impacts[depth + 1, buy].item(), impacts[depth + 1, sell].item()
+				for node, node_inventory, node_cash, node_price, node_reward in columns:
+					node.inventory, node.cash, node.price, node.reward = node_inventory, node_cash, node_price, node_reward
+					node.buy_delta, node.sell_delta = buy_delta, sell_delta
+
+		if reshaped: self.statistics.reshaped += 1
+		if self.policy is not None: self.policy.end_tree()
+		self.pool.trim()
+		return root
+
+	def patch(self, depth, parents, nodes, slots, kept, added):
+		"""
+			Release the nodes of a level that are not kept and link new nodes
+			for the added slots. Returns the nodes and slots of the level, and
+			the new position of each old node, -1 if released.
+		"""
+		released = []
+		for position in np.flatnonzero(~kept).tolist():
+			node = nodes[position]
+			slot = slots[position].item()
+			if slot >= 0:
+				parent, index = divmod(slot, 3)
+				parents[parent]._children[ACTIONS[index].value] = None
+			node._children = None
+			released.append(node)
+		self.statistics.recycled += len(released)
+		self.pool.release(released)
+
+		grown = []
+		for slot in added.tolist():
+			parent, index = divmod(slot, 3)
+			child = self.statistics.new_node(self.pool)
+			child.depth = depth + 1
+			if parents[parent]._children is None: parents[parent]._children = [None, None, None]
+			parents[parent]._children[ACTIONS[index].value] = child
+			grown.append(child)
+
+		positions = np.flatnonzero(kept)
+		remap = np.full(len(nodes), -1, dtype=np.intp)
+		remap[positions] = np.arange(len(positions))
+
+		nodes = [nodes[position] for position in positions.tolist()] + grown
+		return nodes, np.concatenate([slots[positions], added]), remap
@@ -1,6 +1,10 @@
 from market_types import Action, ACTIONS, MarketTreeNode
 
-import random, math
+from tree_traversal import level_order
+
+from collections import OrderedDict
+import numpy as np
+import hashlib, math, random, threading
 
 
 def gaussian_densities(time_horizon, mu = 0.2, std = 0.1):
@@ -60,66 +64,294 @@ def lipschitz_densities(time_horizon, start = 0.3, constant = 0.1):
 	return alphas, betas
 
 
-def deltas_factory(time_horizon, densities):
-	"""Returns the functions defining the market density, for now it is just gaussian"""
+# Batch variants of the density generators, by name of the generator
+BATCH_DENSITIES = {}
+
+def batch_density(density):
+	"""
+		Register the decorated function as the batch variant of a density
+		generator, drawing (N, T) alphas and betas from a NumPy Generator.
+	"""
+	def register(batch):
+		BATCH_DENSITIES[density.__name__] = batch
+		return batch
+	return register
+
+
+def draw_densities(density, amount, time_horizon, generator: np.random.Generator):
+	"""Draw (amount, T) alphas and betas with the batch variant of the density generator"""
+	return BATCH_DENSITIES[density.__name__](amount, time_horizon, generator)
+
+
+@batch_density(gaussian_densities)
+def gaussian_densities_batch(amount, time_horizon, generator, mu = 0.2, std = 0.1):
+	alphas, betas = np.maximum(generator.normal(mu, std, (2, amount, time_horizon)), 0.05)
+	return alphas, betas
+
+
+@batch_density(uniform_densities)
+def uniform_densities_batch(amount, time_horizon, generator, interval = (0.05, 0.5)):
+	alphas, betas = generator.uniform(*interval, (2, amount, time_horizon))
+	return alphas, betas
+
+
+@batch_density(constant_densities)
+def constant_densities_batch(amount, time_horizon, generator, interval = (0.05, 0.5)):
+	alphas, betas = generator.uniform(*interval, (2, amount, 1)).repeat(time_horizon, axis=-1)
+	return alphas, betas
+
+
+@batch_density(symmetrical_densities)
+def symmetrical_densities_batch(amount, time_horizon, generator):
+	alphas, _ = gaussian_densities_batch(amount, time_horizon, generator)
+	return alphas, alphas.copy()
+
+
+@batch_density(alternating_densities)
+def alternating_densities_batch(amount, time_horizon, generator):
+	alphas, betas = gaussian_densities_batch(amount, time_horizon, generator)
+
+	for index in range(1, time_horizon):
+		previous = np.sign(alphas[:, index - 1] - betas[:, index - 1])
+		swap = (previous != 0) & (previous == np.sign(alphas[:, index] - betas[:, index]))
+		alphas[swap, index], betas[swap, index] = betas[swap, index], alphas[swap, index]
+
+	return alphas, betas
+
+
+@batch_density(lipschitz_densities)
+def lipschitz_densities_batch(amount, time_horizon, generator, start = 0.3, constant = 0.1):
+	steps = generator.random((2, amount, time_horizon))
+	walks = np.empty((2, amount, time_horizon))
+
+	x = np.full((2, amount), start)
+	for index in range(time_horizon):
+		low = np.maximum(x - constant, 0.)
+		x = walks[..., index] = low + (x + constant - low) * steps[..., index]
+
+	alphas, betas = walks
+	return alphas, betas
+
+
+def density_impacts(densities) -> np.ndarray:
+	"""
+		Vectorized trading cost functions, densities has shape (..., 2) holding
+		alphas and betas and the price impacts are returned with shape (..., 3)
+		in ACTIONS order. Buying one unit moves the price by 2/3 sqrt(2 / alpha),
+		selling one unit by -2/3 sqrt(2 / beta).
+	"""
+	densities = np.asarray(densities, dtype=float)
+	alphas, betas = densities[..., 0], densities[..., 1]
+	impacts = {
+		Action.BUY: np.sqrt(2 / alphas) * 2 / 3,
+		Action.STAY: np.zeros_like(alphas),
+		Action.SELL: -np.sqrt(2 / betas) * 2 / 3
+	}
+	return np.stack([impacts[action] for action in ACTIONS], axis=-1)
+
+
+class DeltaRow:
+	"""Price impacts of a single round, callable like a trading cost function"""
+	__slots__ = ("impacts",)
+
+	def __init__(self, buy, sell):
+		# Indexed directly by the quantity of the action
+		self.impacts = (0., buy, sell)
+
+	def __call__(self, quantity):
+		return self.impacts[quantity]
+
+
+class DeltaTable:
+	"""
+		Trading cost functions of every round precomputed as a (T, 3) array of
+		price impacts with columns in ACTIONS order. Indexing a round returns a
+		callable DeltaRow, so the table works wherever a list of functions did.
+	"""
+
+	def __init__(self, impacts):
+		self.impacts = np.asarray(impacts, dtype=float).reshape(-1, len(ACTIONS))
+		buy, sell = ACTIONS.index(Action.BUY), ACTIONS.index(Action.SELL)
+		self.rows = [DeltaRow(row[buy], row[sell]) for row in self.impacts.tolist()]
+
+	@classmethod
+	def from_densities(cls, alphas, betas):
+		return cls(density_impacts(np.column_stack([alphas, betas])))
 
-	def delta(alpha, beta):
-		"""Given a market density build the trading cost function"""
-		def inner(quantity):
-			match Action(quantity):
-				case Action.BUY:
-					price_impact = math.sqrt(2 * quantity / alpha)
-				case Action.SELL:
-					price_impact = -math.sqrt(-2 * quantity / beta)
-				case Action.STAY:
-					price_impact = 0
-			return price_impact * 2 / 3
-		return inner
+	def __len__(self):
+		return len(self.rows)
 
+	def __iter__(self):
+		return iter(self.rows)
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return DeltaTable(self.impacts[index])
+		return self.rows[index]
+
+	def digest(self, time_horizon = None) -> str:
+		"""Hash of the impacts of the first time_horizon rounds, equal tables have equal digests"""
+		impacts = np.ascontiguousarray(self.impacts[:time_horizon], dtype="<f8")
+		return hashlib.sha256(impacts.tobytes()).hexdigest()
+
+
+def deltas_factory(time_horizon, densities) -> DeltaTable:
+	"""Returns the trading cost functions of each round given a market density generator"""
 	alphas, betas = densities(time_horizon)
-	return [delta(a, b) for a, b in zip(alphas, betas)]
+	return DeltaTable.from_densities(alphas, betas)
+
 
 def flatten(tree):
 	"""Convert a tree into a list and remove children links"""
-	result = []
-	queue = [tree]
+	result = list(level_order(tree))
 
-	while len(queue) > 0:
-		node = queue.pop(0)
-		queue.extend(node.children.values())
-		result.append(node)
-		node.children = dict()
+	for node in result:
+		node._children = None
 
 	return result
 
-# Cache used to store leaves to build bigger trees without runtime allocation
-unused_leaves = []
-
-def update_tree(root, time_horizon, deltas, inventory, cash, price):
-	"""Given a tree and initialization parameters with deltas, update the tree to reflect the parameters"""
-
+class NodePool:
+	"""
+		Cache of unused nodes to build bigger trees without runtime allocation,
+		safe to share between threads. Nodes released beyond the capacity are
+		dropped, and trim() shrinks the pool down to the high water mark after
+		a large tree has been replaced by a smaller one. The capacity bounds the
+		nodes held while a large tree is reshaped, the high water mark the ones
+		held between updates.
+	"""
+
+	def __init__(self, capacity = 1_000_000, high_water = 100_000):
+		self.capacity = capacity
+		self.high_water = min(high_water, capacity)
+		self.nodes: list[MarketTreeNode] = []
+		self.lock = threading.Lock()
+
+		self.hits = 0
+		self.misses = 0
+		self.allocations = 0
+		self.released = 0
+		self.dropped = 0
+
+	def take(self):
+		"""Pop a node from the pool, or return None if it is empty"""
+		with self.lock:
+			if len(self.nodes) > 0:
+				self.hits += 1
+				return self.nodes.pop()
+			self.misses += 1
+			return None
+
+	def allocate(self):
+		"""Allocate a new node, bypassing the pool"""
+		with self.lock:
+			self.allocations += 1
+		return MarketTreeNode()
+
+	def acquire(self):
+		"""Get a node from the pool, allocating one if the pool is empty"""
+		node = self.take()
+		return node if node is not None else self.allocate()
+
+	def release(self, nodes):
+		"""Store the unlinked nodes for later use, up to the capacity"""
+		with self.lock:
+			kept = max(min(len(nodes), self.capacity - len(self.nodes)), 0)
+			self.nodes.extend(nodes[:kept])
+			self.released += kept
+			self.dropped += len(nodes) - kept
+
+	def trim(self, size = None):
+		"""Drop the nodes beyond the given size, the high water mark by default"""
+		size = self.high_water if size is None else size
+		with self.lock:
+			if len(self.nodes) > size:
+				self.dropped += len(self.nodes) - size
+				del self.nodes[size:]
+
+	def __len__(self):
+		return len(self.nodes)
+
+	def __str__(self):
+		return f"size {len(self)}, hits {self.hits}, misses {self.misses}, allocations {self.allocations}, released {self.released}, dropped {self.dropped}"
+
+
+_thread_pools = threading.local()
+
+def default_pool() -> NodePool:
+	"""Node pool of the current thread"""
+	if not hasattr(_thread_pools, "pool"):
+		_thread_pools.pool = NodePool()
+	return _thread_pools.pool
+
+
+class UpdateStatistics:
+	"""Counters of the nodes handled while updating trees"""
+
+	def __init__(self):
+		self.reused = 0
+		self.pooled = 0
+		self.allocated = 0
+		self.recycled = 0
+		self.reshaped = 0
+
+	def new_node(self, pool: NodePool):
+		"""Get a node from the pool, or allocate one if the pool is empty"""
+		node = pool.take()
+		if node is not None:
+			self.pooled += 1
+			return node
+		self.allocated += 1
+		return pool.allocate()
+
+	def recycle(self, node, pool: NodePool):
+		"""Store the node in the pool alongside its children"""
+		nodes = flatten(node)
+		self.recycled += len(nodes)
+		pool.release(nodes)
+
+	def __str__(self):
+		return f"reused {self.reused}, pooled {self.pooled}, allocated {self.allocated}, recycled {self.recycled}, reshaped {self.reshaped}"
+
+
+def update_tree(root, time_horizon, deltas, inventory, cash, price, statistics = None, policy = None, pool = None):
+	"""
+		Given a tree and initialization parameters with deltas, update the tree to reflect the
+		parameters. Missing nodes are taken from the pool, the thread's one by default.
+	"""
+	pool = pool if pool is not None else default_pool()
 	root.inventory, root.cash, root.price = inventory, cash, price
 	root.reward = cash + price * inventory
-	queue = [root]
 
-	while len(queue) > 0:
-		node = queue.pop(0)
+	if policy is not None: policy.begin_tree()
+	update_subtree(root, time_horizon, deltas, statistics or UpdateStatistics(), pool, policy)
+	if policy is not None: policy.end_tree(root)
+
+	pool.trim()
+	return root
+
+
+def update_subtree(root, time_horizon, deltas, statistics, pool, policy = None):
+	"""Update the descendants of a node to reflect its values"""
+	for node in level_order(root):
 		if node.depth >= time_horizon: continue
 
 		delta = deltas[node.depth]
+		slots = node._children or [None, None, None]
 		for action in ACTIONS:
+			quantity = action.value
+			child = slots[quantity]
 			if node.can_perform(action, delta):
-				if action not in node.children:
-					# Old tree did not contain the node, use one from the cache
-					node.children[action] = unused_leaves.pop() if len(unused_leaves) > 0 else MarketTreeNode()
-				node.children[action].inherit(node, action, delta)
-				queue.append(node.children[action])
-			elif action in node.children:
-				# Remove illegal node and store it in cache alongside its children
-				unused_leaves.extend(flatten(node.children[action]))
-				del node.children[action]
-
-	return root
+				if child is None:
+					# Old tree did not contain the node, use one from the pool
+					child = slots[quantity] = statistics.new_node(pool)
+				else:
+					statistics.reused += 1
+				child.inherit(node, action, delta, policy)
+			elif child is not None:
+				# Remove illegal node and store it in the pool alongside its children
+				statistics.recycle(child, pool)
+				slots[quantity] = None
+		node._children = slots if slots != [None, None, None] else None
 
 
 # def build_complete_tree(deltas, time_horizon = 5):
@@ -141,21 +373,169 @@ def update_tree(root, time_horizon, deltas, inventory, cash, price):
 # 	return root
 
 
-def generate_tree(time_horizon, deltas, inventory = 0, cash = 1, price = 0) :
-	"""Build the market tree up to the given depth and using the given market densities"""
+def generate_tree(time_horizon, deltas, inventory = 0, cash = 1, price = 0, policy = None, pool = None):
+	"""
+		Build the market tree up to the given depth and using the given market
+		densities, taking the nodes from the pool if one is given.
+	"""
 	root = MarketTreeNode(inventory, cash, price)
-	queue = [root]
+	if policy is not None: policy.begin_tree()
+
+	for node in level_order(root):
+		if node.depth >= time_horizon: break
+
+		for action in ACTIONS:
+			node.perform(action, deltas[node.depth], policy, pool)
+
+	if policy is not None: policy.end_tree(root)
+	return root
+
 
-	while len(queue) > 0:
-		node = queue.pop(0)
+def extend_tree(root, deltas, time_horizon, new_horizon, policy = None, pool = None, leaves = None) -> list[MarketTreeNode]:
+	"""
+		Grow a tree built up to time_horizon until new_horizon, expanding only
+		its leaves with the deltas of the new rounds. Returns the new leaves in
+		level order, which can be given back to skip the search of the leaves
+		when extending again.
+	"""
+	if leaves is None:
+		leaves = [node for node in level_order(root, unique=True) if node.depth == time_horizon]
+	if policy is not None: policy.begin_tree()
+
+	for depth in range(time_horizon, new_horizon):
+		frontier = []
+		for node in leaves:
+			for action in ACTIONS:
+				if node.perform(action, deltas[depth], policy, pool):
+					frontier.append(node._children[action.value])
+		leaves = frontier
+
+	if policy is not None: policy.end_tree(root)
+	return leaves
+
+
+class TranspositionTable:
+	"""
+		Map from states to the nodes representing them, evicting the least
+		recently used entries beyond the given capacity. Cash and price are
+		quantized relative to their magnitude with the given tolerance, like
+		the default of math.isclose, so states reached through different orders
+		of the same actions share their key despite rounding errors. Values
+		smaller than the tolerance are taken as zero.
+	"""
+
+	def __init__(self, tolerance = 1e-9, capacity = None):
+		self.tolerance = tolerance
+		self.digits = max(round(-math.log10(tolerance)), 0)
+		self.capacity = capacity
+		self.entries: OrderedDict[tuple, MarketTreeNode] = OrderedDict()
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def quantize(self, value) -> float:
+		"""Round the value to the significant digits implied by the tolerance"""
+		return float(f"{value:.{self.digits}e}") if abs(value) >= self.tolerance else 0.
+
+	def key(self, node):
+		return (node.depth, node.inventory, self.quantize(node.cash), self.quantize(node.price))
+
+	def get(self, node):
+		"""Return the node stored for the same state, or store the given node"""
+		key = self.key(node)
+
+		if key in self.entries:
+			self.hits += 1
+			self.entries.move_to_end(key)
+			return self.entries[key]
+
+		self.misses += 1
+		self.entries[key] = node
+		if self.capacity is not None and len(self.entries) > self.capacity:
+			self.entries.popitem(last = False)
+			self.evictions += 1
+
+		return node
+
+
+def generate_dag(time_horizon, deltas, inventory = 0, cash = 1, price = 0, table = None, policy = None):
+	"""
+		Build the market tree merging the nodes with the same state, the result
+		is a directed acyclic graph where nodes can have more than one parent.
+	"""
+	table = table or TranspositionTable()
+	root = table.get(MarketTreeNode(inventory, cash, price))
+	if policy is not None: policy.begin_tree()
+
+	for node in level_order(root, unique=True):
 		if node.depth >= time_horizon: break
 
+		delta = deltas[node.depth]
 		for action in ACTIONS:
-			if node.perform(action, deltas[node.depth]):
-				queue.append(node.children[action])
+			if not node.can_perform(action, delta): continue
 
+			child = MarketTreeNode()
+			child.inherit(node, action, delta, policy)
+			node.children[action] = table.get(child)
+
+	if policy is not None: policy.end_tree(root)
 	return root
 
+class LazyTreeContext:
+	"""Parameters shared by the nodes of a lazy tree, and the count of the expanded nodes"""
+
+	def __init__(self, time_horizon, deltas, policy = None):
+		self.time_horizon = time_horizon
+		self.deltas = deltas
+		self.policy = policy
+		self.expanded = 0
+
+
+class LazyMarketTreeNode(MarketTreeNode):
+	"""Market tree node whose children are computed the first time they are accessed"""
+	__slots__ = ("context", "expanded")
+
+	def __init__(self, context: LazyTreeContext, inventory: int = 0, cash: float = 0., price: float = 0., depth: int = 0):
+		super().__init__(inventory, cash, price, depth)
+		self.context = context
+		self.expanded = False
+
+	def expand(self):
+		"""Create the children allowed by the constraints"""
+		self.expanded = True
+		context = self.context
+		if self.depth >= context.time_horizon: return
+
+		context.expanded += 1
+		delta = context.deltas[self.depth]
+		for action in ACTIONS:
+			if self.can_perform(action, delta):
+				child = LazyMarketTreeNode(context)
+				child.inherit(self, action, delta, context.policy)
+				if self._children is None: self._children = [None, None, None]
+				self._children[action.value] = child
+
+	@property
+	def children(self):
+		if not self.expanded: self.expand()
+		return MarketTreeNode.children.fget(self)
+
+	def child_nodes(self):
+		if not self.expanded: self.expand()
+		return MarketTreeNode.child_nodes(self)
+
+	@children.setter
+	def children(self, children):
+		self.expanded = True
+		MarketTreeNode.children.fset(self, children)
+
+
+def generate_lazy_tree(time_horizon, deltas, inventory = 0, cash = 1, price = 0, policy = None) -> LazyMarketTreeNode:
+	"""Root of a market tree expanded on demand, the number of expanded nodes is kept in root.context"""
+	return LazyMarketTreeNode(LazyTreeContext(time_horizon, deltas, policy), inventory, cash, price)
+
+
 if __name__ == "__main__":
 	from tree_generation import deltas_factory, gaussian_densities
 	from tree_visualization import draw_market_tree
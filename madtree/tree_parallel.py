@@ -0,0 +1,123 @@
+from market_types import Action, ACTIONS, STAY, feasible
+from tree_array import ArrayMarketTree, price_impacts
+from tree_generation import DeltaTable
+from tree_solver import solve
+
+from multiprocessing import Pool, cpu_count, shared_memory
+from typing import Callable
+import numpy as np
+import math
+
+# Shared arrays attached by each worker, by name
+_shared = {}
+
+
+def share(array: np.ndarray):
+	"""Copy an array in a new shared memory block, returns the block and how to attach to it"""
+	block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+	np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+	return block, (block.name, array.shape, array.dtype.str)
+
+
+def attach(descriptors: dict):
+	"""Pool initializer, map the shared arrays of the frontier in the worker"""
+	for name, (block_name, shape, dtype) in descriptors.items():
+		block = shared_memory.SharedMemory(name=block_name)
+		_shared[name] = (block, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+
+
+def solve_frontier(task):
+	"""
+		Solve the subtrees rooted in a chunk of frontier nodes, returns the best
+		one of the chunk. Each subtree starts from the reward of its frontier
+		node and only has to reach the incumbent, or beat the best of the chunk.
+	"""
+	start, stop, split_depth, incumbent, policy = task
+	impacts = DeltaTable(_shared["impacts"][1][split_depth:])
+	states = zip(*(_shared[name][1][start:stop].tolist() for name in ("index", "inventory", "cash", "price", "reward")))
+
+	best = (-math.inf, None, [])
+	for index, inventory, cash, price, reward in states:
+		reward, actions = solve(len(impacts), impacts, inventory, cash, price, policy, reward,
+			max(incumbent, math.nextafter(best[0], math.inf)))
+		if reward > best[0]:
+			best = (reward, index, actions)
+
+	return best, policy
+
+
+def split_depth_for(time_horizon: int, processes: int) -> int:
+	"""Shallowest depth with enough nodes to keep every process busy"""
+	return min(time_horizon, math.ceil(math.log(8 * processes, 3)))
+
+
+def solve_parallel(time_horizon, deltas: list[Callable[[int], float]], inventory = 0, cash = 1, price = 0, split_depth = None,
+		processes = None, chunk_size = None, policy = None) -> tuple[float, list[Action]]:
+	"""
+		Parallel solve of a single large tree. The first split_depth levels are
+		expanded serially as an ArrayMarketTree, then the nodes of the frontier
+		are placed in shared memory and each worker solves the subtrees of a
+		chunk of them, returning only the best reward and actions. Holding the
+		inventory from the frontier to the horizon reaches leaves of the tree,
+		so the best of those rewards is a lower bound given to the workers.
+		Ties are broken in level order like solve does. The prefix is validated with
+		the policy, and each chunk with a fresh copy of it whose counters are
+		then added to the given one.
+	"""
+	processes = processes or max(cpu_count() - 1, 1)
+	split_depth = split_depth_for(time_horizon, processes) if split_depth is None else min(split_depth, time_horizon)
+
+	impacts = price_impacts(deltas[:time_horizon])
+	prefix = ArrayMarketTree(split_depth, DeltaTable(impacts), inventory, cash, price, policy)
+
+	# Only the valid nodes of the frontier are handed to the workers
+	level = prefix.level(split_depth)
+	frontier = np.flatnonzero(prefix.valid[level]) + level.start
+	if split_depth == time_horizon or len(frontier) == 0:
+		best = prefix.best_leaf()
+		return prefix.reward[best].item(), prefix.action_path(best)
+
+	arrays = {
+		"impacts": impacts,
+		"index": frontier,
+		"inventory": prefix.inventory[frontier],
+		"cash": prefix.cash[frontier],
+		"price": prefix.price[frontier],
+		"reward": prefix.reward[frontier]
+	}
+
+	# Rewards of holding, added up in the same order as solve does
+	inventory, cash, held_price, held_reward = (arrays[name] for name in ("inventory", "cash", "price", "reward"))
+	holds = np.ones(len(frontier), dtype=bool)
+	for price_change in impacts[split_depth:, ACTIONS.index(Action.STAY)]:
+		holds &= feasible(inventory, cash, held_price, STAY, price_change)
+		held_reward = held_reward + inventory * price_change
+		held_price = held_price + price_change
+	incumbent = held_reward[holds].max().item() if holds.any() else -math.inf
+
+	chunk_size = chunk_size or max(1, math.ceil(len(frontier) / (4 * processes)))
+	tasks = [(start, min(start + chunk_size, len(frontier)), split_depth, incumbent, policy.fresh() if policy is not None else None)
+		for start in range(0, len(frontier), chunk_size)]
+
+	blocks = []
+	try:
+		descriptors = {}
+		for name, array in arrays.items():
+			block, descriptors[name] = share(np.ascontiguousarray(array))
+			blocks.append(block)
+
+		with Pool(processes, initializer=attach, initargs=(descriptors,)) as pool:
+			partials = pool.map(solve_frontier, tasks)
+	finally:
+		for block in blocks:
+			block.close()
+			block.unlink()
+
+	# Chunks are in level order, the first of the best ones wins the ties
+	best_reward, best_index, best_actions = -math.inf, None, []
+	for (reward, index, actions), chunk_policy in partials:
+		if reward > best_reward:
+			best_reward, best_index, best_actions = reward, index, actions
+		if policy is not None: policy.merge(chunk_policy)
+
+	return best_reward, prefix.action_path(best_index) + best_actions
@@ -0,0 +1,48 @@
+from market_types import MarketTreeNode, Action
+from tree_traversal import level_order
+
+
+def highest_reward_leaf(tree: MarketTreeNode) -> list[MarketTreeNode]:
+	# I should check for multiple leaves with the highest reward, but it's very unlikely
+
+	max_reward = tree.reward
+	leaves = []
+
+	for node in level_order(tree, unique=True):
+		if len(node.children) == 0:
+			leaves.append(node)
+			max_reward = max(max_reward, node.reward)
+
+	return next(leaf for leaf in leaves if leaf.reward == max_reward)
+
+
+def path_to_leaf(root: MarketTreeNode, leaf: MarketTreeNode) -> list[MarketTreeNode]:
+	# A bit of backtracking programming, because it's fun
+	dead_ends = set()
+
+	def rec_path(path: list[MarketTreeNode], leaf: MarketTreeNode) -> bool:
+		last_node = path[-1]
+		if last_node == leaf: return True
+
+		for child in last_node.children.values():
+			# Nodes shared by several parents are explored once
+			if child in dead_ends: continue
+			path.append(child)
+			if rec_path(path, leaf):
+				return True
+			dead_ends.add(path.pop())
+
+		return False
+
+	path = [root]
+	rec_path(path, leaf)
+	return path
+
+
+def action_path(path: list[MarketTreeNode]) -> list[Action]:
+	actions = []
+	for depth in range(1, len(path)):
+		parent, node = path[depth - 1], path[depth]
+		action = next(action for action, child in parent.children.items() if child == node)
+		actions.append(action)
+	return actions
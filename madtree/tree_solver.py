@@ -0,0 +1,449 @@
+from market_types import Action, ACTIONS, can_trade
+from tree_array import QUANTITIES, ArrayMarketTree, expand_level, price_impacts
+from tree_generation import density_impacts, generate_lazy_tree
+from validation import ValidationPolicy
+
+from typing import Callable
+import numpy as np
+import heapq, math, random
+
+# Longest horizon for which optimality_gap runs solve by default
+EXACT_HORIZON = 12
+
+# Upper limit on the number of leaves expanded at once by solve_batch
+BATCH_LEAVES = 1 << 22
+
+# Called with the number of pruned branches after every solve, set by instrumentation
+on_solve = None
+
+
+class RewardBound:
+	"""
+		Optimistic estimate of the reward reachable from a state. At every round
+		the inventory grows by at most one and each unit gains at most the
+		largest price change of the round, so the bound can be computed in
+		constant time from two suffix sums over the rounds.
+
+		Given the price as well, the inventory is capped by the units the state
+		can afford: the cash never goes negative, so inventory * price cannot
+		exceed the reward, while every buy raises the price by at least the
+		smallest buy impact left and a sell lowers it by at most the largest
+		drop left. The bound is then the best reward of a dynamic program over
+		the inventories up to the cap, computed once per cap, which in turn
+		bounds the reward used for the cap until the cap stops decreasing.
+		The cap needs integer inventories and price impacts that rise on BUY
+		and stay put on STAY, as the density generators give.
+	"""
+
+	def __init__(self, impacts: list[list[float]]):
+		gains = [max(max(row), 0.) for row in impacts]
+		self.time_horizon = len(gains)
+
+		# units[d] = sum_{t >= d} gains[t], steps[d] = sum_{t >= d} (t - d) gains[t]
+		self.units = [0.] * (self.time_horizon + 1)
+		self.steps = [0.] * (self.time_horizon + 1)
+		for depth in reversed(range(self.time_horizon)):
+			self.units[depth] = self.units[depth + 1] + gains[depth]
+			self.steps[depth] = self.steps[depth + 1] + self.units[depth + 1]
+
+		self.impacts = np.asarray(impacts, dtype=float).reshape(-1, len(ACTIONS))
+		buys, stays, sells = (self.impacts[:, ACTIONS.index(action)] for action in (Action.BUY, Action.STAY, Action.SELL))
+		self.capped = bool((buys >= 0).all() and (stays == 0).all())
+
+		# With g more units, of which the ones sold are bought back, the price is at least
+		# price - shift[d] + slope[d] g: every buy raises it by the smallest buy impact left,
+		# and selling as much as the rounds allow lowers it only if the drops exceed that
+		rounds = np.arange(self.time_horizon, 0, -1)
+		cheapest = np.minimum.accumulate(buys[::-1])[::-1]
+		excess = np.maximum(np.maximum.accumulate(np.maximum(-sells, 0.)[::-1])[::-1] - cheapest, 0.)
+		self.shift = (rounds * excess / 2).tolist() + [0.]
+		self.slope = (cheapest + excess / 2).tolist() + [0.]
+		self.tables: dict[int, list[list[float]]] = {}
+
+	def table(self, cap: int) -> list[list[float]]:
+		"""Highest reward gain from every depth and inventory when the inventory never exceeds the cap"""
+		if cap not in self.tables:
+			inventories = np.arange(cap + 1, dtype=float)
+			gains = np.zeros((self.time_horizon + 1, cap + 1))
+
+			for depth in reversed(range(self.time_horizon)):
+				buy, stay, sell = (self.impacts[depth, ACTIONS.index(action)] for action in (Action.BUY, Action.STAY, Action.SELL))
+				after = gains[depth + 1]
+				best = after + inventories * stay
+				best[:-1] = np.maximum(best[:-1], inventories[:-1] * buy + after[1:])
+				best[1:] = np.maximum(best[1:], inventories[1:] * sell + after[:-1])
+				gains[depth] = best
+
+			self.tables[cap] = gains.tolist()
+		return self.tables[cap]
+
+	@staticmethod
+	def affordable(inventory, reward, c0, c1) -> float:
+		"""Highest inventory with (inventory + g)(c0 + c1 g) at most the reward"""
+		b, c = c0 + inventory * c1, inventory * c0 - reward
+		return inventory + (-b + math.sqrt(max(b * b - 4 * c1 * c, 0.))) / (2 * c1)
+
+	def __call__(self, depth: int, inventory, reward: float, price: float = None, incumbent: float = -math.inf) -> float:
+		bound = reward + inventory * self.units[depth] + self.steps[depth]
+		if price is None or not self.capped or bound <= incumbent: return bound
+
+		c0, c1 = price - self.shift[depth], self.slope[depth]
+		if c0 <= 0 or c1 <= 0 or inventory != int(inventory): return bound
+
+		# The inventory grows by one at most every round anyway
+		inventory = int(inventory)
+		most = inventory + self.time_horizon - depth
+		cap = max(int(min(self.affordable(inventory, bound, c0, c1), most)), inventory)
+
+		while cap < most:
+			most = cap
+			bound = reward + self.table(cap)[depth][inventory]
+			cap = max(int(min(self.affordable(inventory, bound, c0, c1), most)), inventory)
+		return bound
+
+
+def solve(time_horizon, deltas: list[Callable[[int], float]], inventory = 0, cash = 1, price = 0, policy = None,
+		reward = None, incumbent = -math.inf) -> tuple[float, list[Action]]:
+	"""
+		Find the highest reward reachable within the time horizon and the actions
+		leading to it, without building the tree. The states are explored depth
+		first and a branch is dropped as soon as its RewardBound cannot beat the
+		best leaf found so far. Ties are broken like highest_reward_leaf does.
+		The reward of the explored states is checked as the policy says.
+		The starting reward defaults to the wealth of the root, and only the
+		leaves reaching at least the incumbent are considered: when there are
+		none the reward is -inf.
+	"""
+	impacts = price_impacts(deltas[:time_horizon]).tolist()
+	bound = RewardBound(impacts)
+
+	# Just below the incumbent, so that a leaf reaching it exactly is still taken
+	best_reward, best_actions = math.nextafter(incumbent, -math.inf), []
+	actions = []
+	pruned = 0
+
+	def search(depth, inventory, cash, price, reward):
+		nonlocal best_reward, best_actions, pruned
+		is_leaf = True
+
+		if depth < time_horizon:
+			for action, price_change in zip(ACTIONS, impacts[depth]):
+				quantity = action.value
+				if not can_trade(inventory, cash, price, quantity, price_change): continue
+				is_leaf = False
+
+				child_inventory = inventory + quantity
+				child_reward = reward + inventory * price_change
+				child_price = price + price_change
+				if bound(depth + 1, child_inventory, child_reward, child_price, best_reward) <= best_reward:
+					pruned += 1
+					continue
+
+				child_cash = cash - quantity * child_price
+
+				if policy is not None:
+					if policy.sample(): policy.check(child_reward, child_cash, child_inventory, child_price)
+					elif policy.deferred: policy.defer(child_reward, child_cash, child_inventory, child_price)
+
+				actions.append(action)
+				search(depth + 1, child_inventory, child_cash, child_price, child_reward)
+				actions.pop()
+
+		if is_leaf and reward > best_reward:
+			best_reward, best_actions = reward, actions.copy()
+
+	if policy is not None: policy.begin_tree()
+	search(0, inventory, cash, price, cash + price * inventory if reward is None else reward)
+	if policy is not None: policy.end_tree()
+	if on_solve is not None: on_solve(pruned)
+
+	if best_reward < incumbent: return -math.inf, []
+	return best_reward, best_actions
+
+
+def best_first(time_horizon, deltas: list[Callable[[int], float]], inventory = 0, cash = 1, price = 0, policy = None) -> tuple[float, list[Action], int]:
+	"""
+		Find the highest reward reachable within the time horizon on a lazy tree,
+		always expanding the node with the highest RewardBound and plunging from
+		it down to a leaf along the children of highest bound, the others are
+		kept in the frontier. The leaves found raise the incumbent, which starts
+		from the leaf of beam_search, and nodes that cannot beat it are dropped,
+		as are the links to the children of expanded nodes, so that only the
+		frontier is kept in memory. Returns the reward, the actions and the
+		number of expanded nodes.
+	"""
+	root = generate_lazy_tree(time_horizon, deltas, inventory, cash, price, policy)
+	bound = RewardBound(price_impacts(deltas[:time_horizon]).tolist())
+	best_reward, best_actions, _ = beam_search(time_horizon, deltas, inventory, cash, price, exact_horizon = 0)
+
+	# Entries are (-bound, tie breaker, node, actions as a linked list)
+	frontier = [(-bound(0, root.inventory, root.reward, root.price), 0, root, None)]
+	counter = 1
+
+	while len(frontier) > 0:
+		priority, _, node, actions = heapq.heappop(frontier)
+		if -priority <= best_reward: break
+
+		while node is not None:
+			if not node.expanded: node.expand()
+			slots, node._children = node._children, None
+
+			if slots is None:
+				if node.reward > best_reward:
+					path = []
+					while actions is not None:
+						action, actions = actions
+						path.append(action)
+					best_reward, best_actions = node.reward, path[::-1]
+				break
+
+			# Plunge into the child of highest bound, the first one on ties
+			plunge = None
+			for action in ACTIONS:
+				child = slots[action.value]
+				if child is None: continue
+				child_bound = bound(child.depth, child.inventory, child.reward, child.price, best_reward)
+				if child_bound <= best_reward: continue
+
+				entry = (-child_bound, counter, child, (action, actions))
+				counter += 1
+				if plunge is None or entry < plunge:
+					if plunge is not None: heapq.heappush(frontier, plunge)
+					plunge = entry
+				else:
+					heapq.heappush(frontier, entry)
+
+			node, actions = (plunge[2], plunge[3]) if plunge is not None else (None, None)
+
+	return best_reward, best_actions, root.context.expanded
+
+
+def solve_horizons(time_horizon, deltas, inventory = 0, cash = 1, price = 0, first = 1, policy = None) -> dict[int, tuple[float, list[Action]]]:
+	"""
+		Highest reward and actions leading to it for every horizon from first to
+		time_horizon, out of a single ArrayMarketTree. Ties are broken like
+		solve does for each horizon.
+	"""
+	return ArrayMarketTree(time_horizon, deltas, inventory, cash, price, policy).best_paths(first)
+
+
+def transitions(depth, inventory, cash, price, impacts, reward = None, policy = None):
+	"""
+		Feasible moves from a state, as (action, inventory, cash, price, reward
+		gain) in ACTIONS order. Given the reward, the children are checked as
+		the policy says.
+	"""
+	moves = []
+	for action, price_change in zip(ACTIONS, impacts[depth]):
+		quantity = action.value
+		if can_trade(inventory, cash, price, quantity, price_change):
+			child_price = price + price_change
+			child_inventory, child_cash = inventory + quantity, cash - quantity * child_price
+			gain = inventory * price_change
+			moves.append((action, child_inventory, child_cash, child_price, gain))
+
+			if policy is not None and reward is not None:
+				if policy.sample(): policy.check(reward + gain, child_cash, child_inventory, child_price)
+				elif policy.deferred: policy.defer(reward + gain, child_cash, child_inventory, child_price)
+	return moves
+
+
+def optimality_gap(reward, time_horizon, deltas, inventory, cash, price, exact_horizon = EXACT_HORIZON):
+	"""Difference between the optimal reward and the given one, None if the horizon is too long to solve"""
+	if time_horizon > exact_horizon: return None
+	best_reward, _ = solve(time_horizon, deltas, inventory, cash, price)
+	return best_reward - reward
+
+
+def beam_search(time_horizon, deltas, inventory = 0, cash = 1, price = 0, width = 64, exact_horizon = EXACT_HORIZON, policy = None):
+	"""
+		Approximate solver keeping only the width states with the highest
+		RewardBound at every round. Returns the reward, the actions and the
+		gap to the optimal reward when the horizon is at most exact_horizon,
+		which costs a call to solve.
+	"""
+	if policy is not None: policy.begin_tree()
+	impacts = price_impacts(deltas[:time_horizon]).tolist()
+	bound = RewardBound(impacts)
+	root = (inventory, cash, price)
+
+	# States are (reward, inventory, cash, price, actions as a linked list)
+	beam = [(cash + price * inventory, inventory, cash, price, None)]
+	finished = []
+
+	for depth in range(time_horizon):
+		candidates = []
+		for reward, inventory, cash, price, actions in beam:
+			moves = transitions(depth, inventory, cash, price, impacts, reward, policy)
+			if len(moves) == 0: finished.append((reward, actions))
+
+			for action, child_inventory, child_cash, child_price, gain in moves:
+				candidates.append((reward + gain, child_inventory, child_cash, child_price, (action, actions)))
+
+		key = lambda state: bound(depth + 1, state[1], state[0])
+		beam = heapq.nlargest(width, candidates, key=key)
+
+	if policy is not None: policy.end_tree()
+	finished.extend((reward, actions) for reward, *_, actions in beam)
+	reward, actions = max(finished, key=lambda leaf: leaf[0])
+
+	path = []
+	while actions is not None:
+		action, actions = actions
+		path.append(action)
+
+	return reward, path[::-1], optimality_gap(reward, time_horizon, deltas, *root, exact_horizon)
+
+
+class MonteCarloNode:
+	"""Node of the Monte Carlo search tree, holding a state and the statistics of the rollouts through it"""
+	__slots__ = ("depth", "inventory", "cash", "price", "reward", "action", "parent", "children", "untried", "visits", "total", "exhausted")
+
+	def __init__(self, depth, inventory, cash, price, reward, action = None, parent = None):
+		self.depth = depth
+		self.inventory, self.cash, self.price, self.reward = inventory, cash, price, reward
+		self.action, self.parent = action, parent
+		self.children = []
+		self.untried = None
+		self.visits = 0
+		self.total = 0.
+		# Whether every path below the node has been tried
+		self.exhausted = False
+
+
+def monte_carlo_search(time_horizon, deltas, inventory = 0, cash = 1, price = 0, budget = 10_000, exploration = math.sqrt(2), seed = None,
+		random_moves = 0.1, exact_horizon = EXACT_HORIZON, policy = None):
+	"""
+		Approximate solver growing a Monte Carlo search tree of at most budget
+		nodes with UCT, completing every path with the feasible move of highest
+		RewardBound, or a random one with probability random_moves. The rewards
+		of the rollouts are normalized with the range seen so far, and subtrees
+		explored completely are not selected again. The incumbent is the best of
+		holding and of a rollout from the root without random moves. Returns the
+		reward and the actions of the best path, and the gap to the optimal
+		reward when the horizon is at most exact_horizon, see beam_search.
+	"""
+	impacts = price_impacts(deltas[:time_horizon]).tolist()
+	generator = random.Random(seed)
+	bound = RewardBound(impacts)
+	if policy is not None: policy.begin_tree()
+
+	def rollout(depth, inventory, cash, price, reward, random_moves):
+		"""Complete a path with the move of highest bound, or a random one with probability random_moves"""
+		actions = []
+		while depth < time_horizon:
+			moves = transitions(depth, inventory, cash, price, impacts)
+			if len(moves) == 0: break
+			# Uniform moves lose to holding on long horizons, the bound steers the rollouts
+			if random_moves > 0 and generator.random() < random_moves:
+				move = generator.choice(moves)
+			else:
+				move = max(moves, key=lambda move: bound(depth + 1, move[1], reward + move[4]))
+			action, inventory, cash, price, gain = move
+			reward += gain
+			depth += 1
+			actions.append(action)
+		return reward, actions
+
+	root = MonteCarloNode(0, inventory, cash, price, cash + price * inventory)
+
+	# The incumbent holds the inventory until the horizon, when staying is feasible
+	best_reward, best_actions = root.reward, [Action.STAY] * time_horizon
+	stay, stay_price = ACTIONS.index(Action.STAY), price
+	for depth in range(time_horizon):
+		price_change = impacts[depth][stay]
+		if not can_trade(inventory, cash, stay_price, Action.STAY.value, price_change):
+			best_reward, best_actions = -math.inf, []
+			break
+		best_reward += inventory * price_change
+		stay_price += price_change
+
+	greedy_reward, greedy_actions = rollout(0, inventory, cash, price, root.reward, 0.)
+	if greedy_reward > best_reward:
+		best_reward, best_actions = greedy_reward, greedy_actions
+	low, high = math.inf, -math.inf
+	size = 1
+
+	while size < budget and not root.exhausted:
+		# Selection, descend through the nodes without moves left to try
+		node = root
+		while node.untried is not None and len(node.untried) == 0:
+			scale = max(high - low, 1e-12)
+			children = [child for child in node.children if not child.exhausted]
+			node = max(children, key=lambda child: (child.total / child.visits - low) / scale \
+				+ exploration * math.sqrt(math.log(node.visits) / child.visits))
+
+		# Expansion
+		if node.untried is None:
+			node.untried = transitions(node.depth, node.inventory, node.cash, node.price, impacts, node.reward, policy) \
+				if node.depth < time_horizon else []
+		if len(node.untried) > 0:
+			action, *state, gain = node.untried.pop(generator.randrange(len(node.untried)))
+			child = MonteCarloNode(node.depth + 1, *state, node.reward + gain, action, node)
+			node.children.append(child)
+			node = child
+			size += 1
+
+		# Rollout
+		reward, actions = rollout(node.depth, node.inventory, node.cash, node.price, node.reward, random_moves)
+
+		if reward > best_reward:
+			prefix = []
+			ancestor = node
+			while ancestor.parent is not None:
+				prefix.append(ancestor.action)
+				ancestor = ancestor.parent
+			best_reward, best_actions = reward, prefix[::-1] + actions
+
+		# Backpropagation, terminal nodes are scored by their own reward
+		low, high = min(low, reward), max(high, reward)
+		if node.untried is None and (node.depth >= time_horizon or len(actions) == 0):
+			node.untried = []
+		while node is not None:
+			node.visits += 1
+			node.total += reward
+			if node.untried is not None and len(node.untried) == 0 and all(child.exhausted for child in node.children):
+				node.exhausted = True
+			node = node.parent
+
+	if policy is not None: policy.end_tree()
+	return best_reward, best_actions, optimality_gap(best_reward, time_horizon, deltas, root.inventory, root.cash, root.price, exact_horizon)
+
+
+def solve_batch(states, densities, chunk_size = None, policy = None) -> np.ndarray:
+	"""
+		Solve many instances at once by expanding their trees level by level
+		with broadcasting. The states have shape (N, 3) and hold inventory, cash
+		and price, the densities have shape (N, T, 2) and hold alphas and betas.
+		Returns the (N, T) matrix with the values of the best actions, ties are
+		broken like solve does. Unless the policy is off, the leaves are checked.
+	"""
+	states = np.asarray(states, dtype=float).reshape(-1, 3)
+	impacts = density_impacts(densities)
+	amount, time_horizon = impacts.shape[:2]
+
+	if chunk_size is None:
+		chunk_size = max(1, BATCH_LEAVES // 3 ** time_horizon)
+
+	actions = np.empty((amount, time_horizon), dtype=np.int8)
+	for start in range(0, amount, chunk_size):
+		chunk = slice(start, start + chunk_size)
+		inventory, cash, price = (states[chunk, column, np.newaxis] for column in range(3))
+		reward = cash + price * inventory
+		valid = np.ones_like(reward, dtype=bool)
+
+		for depth in range(time_horizon):
+			inventory, cash, price, reward, valid = \
+				expand_level(inventory, cash, price, reward, valid, impacts[chunk, depth])
+
+		policy = policy or ValidationPolicy("deferred")
+		policy.begin_tree()
+		policy.check_arrays(reward, cash, inventory, price, valid)
+
+		# The position of a leaf in its level spells the actions in base 3
+		position = np.where(valid, reward, -np.inf).argmax(axis=-1)
+		for depth in reversed(range(time_horizon)):
+			actions[chunk, depth] = QUANTITIES[position % 3]
+			position //= 3
+
+	return actions
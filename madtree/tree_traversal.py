@@ -0,0 +1,55 @@
+from collections import deque
+from typing import Callable, Iterator
+
+
+def level_order(root, unique: bool = False) -> Iterator:
+	"""
+		Iterate the nodes of a tree in breadth-first order. The children of a
+		node, listed by its child_nodes method, are read only after it has
+		been yielded, so children added or removed by the consumer in the
+		meantime are taken into account. With unique, nodes shared by several
+		parents are yielded only once.
+	"""
+	queue = deque([root])
+	seen = {root} if unique else None
+
+	while len(queue) > 0:
+		node = queue.popleft()
+		yield node
+
+		children = node.child_nodes()
+		if unique:
+			children = [child for child in children if child not in seen]
+			seen.update(children)
+		queue.extend(children)
+
+
+def depth_first(root, unique: bool = False) -> Iterator:
+	"""
+		Iterate the nodes of a tree in depth-first pre-order, visiting the
+		children in the same order as level_order does.
+	"""
+	stack = [root]
+	seen = {root} if unique else None
+
+	while len(stack) > 0:
+		node = stack.pop()
+		yield node
+
+		children = node.child_nodes()
+		if unique:
+			children = [child for child in children if child not in seen]
+			seen.update(children)
+		stack.extend(reversed(children))
+
+
+def visit(root, visitor: Callable, order: Callable = level_order, unique: bool = False):
+	"""
+		Call the visitor on the nodes of the tree in the given order, stopping as
+		soon as it returns True. Returns the node where the traversal stopped, or
+		None if the visitor went through the whole tree.
+	"""
+	for node in order(root, unique):
+		if visitor(node):
+			return node
+	return None
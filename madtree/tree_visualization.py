@@ -1,67 +1,27 @@
 from market_types import MarketTreeNode, Action, ACTIONS
+from tree_traversal import level_order
+from tree_array import ArrayMarketTree, ArrayNodeView
+from tree_search import highest_reward_leaf, path_to_leaf, action_path
 
+from matplotlib.collections import LineCollection, PolyCollection
 import matplotlib.pyplot as plt
 from typing import Callable
 from itertools import chain
 import networkx as nx
-
-
-def highest_reward_leaf(tree: MarketTreeNode) -> list[MarketTreeNode]:
-	# I should check for multiple leaves with the highest reward, but it's very unlikely
-
-	queue = [tree]
-	max_reward = tree.reward
-	leaves = []
-
-	while len(queue) > 0:
-		node = queue.pop(0)
-		queue.extend(node.children.values())
-
-		if len(node.children) == 0:
-			leaves.append(node)
-			max_reward = max(max_reward, node.reward)
-
-	return next(leaf for leaf in leaves if leaf.reward == max_reward)
-
-
-def path_to_leaf(root: MarketTreeNode, leaf: MarketTreeNode) -> list[MarketTreeNode]:
-	# A bit of backtracking programming, because it's fun
-	def rec_path(path: list[MarketTreeNode], leaf: MarketTreeNode) -> bool:
-		last_node = path[-1]
-		if last_node == leaf: return True
-
-		for child in last_node.children.values():
-			path.append(child)
-			if rec_path(path, leaf):
-				return True
-			path.pop()
-
-		return False
-
-	path = [root]
-	rec_path(path, leaf)
-	return path
-
-
-def action_path(path: list[MarketTreeNode]) -> list[Action]:
-	actions = []
-	for depth in range(1, len(path)):
-		parent, node = path[depth - 1], path[depth]
-		action = next(action for action, child in parent.children.items() if child == node)
-		actions.append(action)
-	return actions
+import numpy as np
 
 
 def convert_to_nx(tree: MarketTreeNode, deltas: list[Callable[[int], float]]):
 	"""Convert the tree to NetworkX DiGraph format"""
 	graph = nx.DiGraph()
-	queue = [(None, tree)]
 
-	while len(queue) > 0:
-		_, node = queue.pop(0)
+	# Number the nodes in order of discovery, views of the same node share the number
+	keys = {}
+	key = lambda node: keys.setdefault(node, len(keys))
 
+	for node in level_order(tree, unique=True):
 		graph.add_node(
-			id(node),
+			key(node),
 			inventory=node.inventory,
 			cash=node.cash,
 			price=node.price,
@@ -70,16 +30,15 @@ def convert_to_nx(tree: MarketTreeNode, deltas: list[Callable[[int], float]]):
 		)
 
 		if hasattr(node, "buy_delta"):
-			graph.nodes[id(node)]["buy_delta"] = node.buy_delta
-			graph.nodes[id(node)]["sell_delta"] = node.sell_delta
+			graph.nodes[key(node)]["buy_delta"] = node.buy_delta
+			graph.nodes[key(node)]["sell_delta"] = node.sell_delta
 
 		for (action, child) in node.children.items():
 			graph.add_edge(
-				id(node), id(child),
+				key(node), key(child),
 				action=action.value,
 				delta=deltas[node.depth](action.value)
 			)
-			queue.append((action, child))
 
 	return graph
 
@@ -115,7 +74,9 @@ def draw_nx(graph: nx.DiGraph, title=""):
 
 	# node_data = nx.get_node_attributes(graph, "data")
 	node_rewards = nx.get_node_attributes(graph, "reward")
-	nodes = nx.draw_networkx_nodes(graph, position, ax=ax, cmap=plt.cm.Blues, node_color=list(node_rewards.values()))
+	# The annotations below look nodes up by their position in this list
+	nodelist = list(graph.nodes)
+	nodes = nx.draw_networkx_nodes(graph, position, ax=ax, nodelist=nodelist, cmap=plt.cm.Blues, node_color=[node_rewards[node] for node in nodelist])
 
 	action_distributions = []
 	for path in nx_highest_reward_paths(graph):
@@ -139,9 +100,7 @@ def draw_nx(graph: nx.DiGraph, title=""):
 	annot = ax.annotate("", xy=(20, 20), xytext=(.95, .95), textcoords="axes fraction", 
 		ha="right", va="top", multialignment="left", family="monospace")
 
-	idx_to_node = {}
-	for idx, node in enumerate(graph.nodes):
-		idx_to_node[idx] = node
+	idx_to_node = dict(enumerate(nodelist))
 
 	def update_annot(ind):
 		idx = ind["ind"][0]
@@ -175,6 +134,106 @@ def draw_market_tree(tree: MarketTreeNode, deltas: list[Callable[[int], float]],
 	draw_nx(graph, title)
 
 
+def indexed_nodes(tree) -> tuple[np.ndarray, np.ndarray]:
+	"""
+		Ternary level-order indices and rewards of the nodes of a tree, the
+		child of node i through the k-th action has index 3i + 1 + k. Nodes
+		shared by several parents get one index per path.
+	"""
+	if isinstance(tree, ArrayNodeView): tree = tree.tree
+	if isinstance(tree, ArrayMarketTree):
+		indices = np.flatnonzero(tree.valid)
+		return indices, tree.reward[indices]
+
+	indices, rewards = [], []
+	stack = [(0, tree)]
+	while len(stack) > 0:
+		index, node = stack.pop()
+		indices.append(index)
+		rewards.append(node.reward)
+		stack.extend((3 * index + 1 + ACTIONS.index(action), child) for action, child in node.children.items())
+
+	order = np.argsort(indices)
+	return np.array(indices, dtype=np.int64)[order], np.array(rewards, dtype=float)[order]
+
+
+def ternary_layout(indices: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+	"""Depth and (x, y) coordinates of ternary indices, each level spans [0, 1] with equally spaced nodes"""
+	indices = np.asarray(indices, dtype=np.int64)
+	max_depth = int(np.log(2 * indices.max() + 1) / np.log(3)) + 1 if len(indices) > 0 else 0
+	offsets = ArrayMarketTree.level_offset(np.arange(max_depth + 2, dtype=np.int64))
+
+	depth = np.searchsorted(offsets, indices, side="right") - 1
+	x = (indices - offsets[depth] + .5) / 3. ** depth
+	return depth, x, -depth.astype(float)
+
+
+def draw_tree(tree, actions: list[Action] = None, max_nodes = 20_000, title = None, ax = None, cmap = "Blues"):
+	"""
+		Draw a tree without computing a graph layout, placing each node from its
+		depth and ternary index. Nodes and edges are drawn as collections, and
+		when the tree has more than max_nodes nodes the deepest levels collapse
+		into a triangle per subtree colored by its best reward. The path of the
+		given actions, for example the output of solve, is highlighted, by
+		default the one to the best leaf.
+	"""
+	ax = ax or plt.subplots()[1]
+	indices, rewards = indexed_nodes(tree)
+	depth, x, y = ternary_layout(indices)
+	time_horizon = int(depth.max())
+
+	# Deepest level drawn node by node
+	detail = 0
+	while detail < time_horizon and ArrayMarketTree.level_offset(detail + 2) <= max_nodes:
+		detail += 1
+
+	norm = plt.Normalize(rewards.min(), rewards.max())
+	shown = depth <= detail
+	position = dict(zip(indices.tolist(), zip(x.tolist(), y.tolist())))
+
+	inner = shown & (depth > 0)
+	parents = (indices[inner] - 1) // 3
+	segments = [(position[parent], position[child]) for parent, child in zip(parents.tolist(), indices[inner].tolist())]
+	ax.add_collection(LineCollection(segments, colors="gray", linewidths=.5, zorder=1))
+
+	if detail < time_horizon:
+		hidden = ~shown
+		ancestors = ArrayMarketTree.level_offset(detail) + (indices[hidden] - ArrayMarketTree.level_offset(depth[hidden])) // 3 ** (depth[hidden] - detail)
+		best = {}
+		for ancestor, reward in zip(ancestors.tolist(), rewards[hidden].tolist()):
+			best[ancestor] = max(reward, best.get(ancestor, reward))
+
+		width = .5 / 3 ** detail
+		triangles = [[position[a], (position[a][0] - width, -time_horizon), (position[a][0] + width, -time_horizon)] for a in best]
+		ax.add_collection(PolyCollection(triangles, array=np.array(list(best.values())), cmap=cmap, norm=norm, alpha=.6, zorder=1))
+
+	points = ax.scatter(x[shown], y[shown], c=rewards[shown], cmap=cmap, norm=norm, s=max(2., 40. / (detail + 1)), zorder=2)
+
+	if actions is None:
+		leaves = indices[depth == time_horizon]
+		best_leaf = leaves[np.argmax(rewards[depth == time_horizon])]
+		path = [int(best_leaf)]
+		while path[-1] != 0: path.append((path[-1] - 1) // 3)
+		path = path[::-1]
+	else:
+		path = [0]
+		for action in actions:
+			path.append(3 * path[-1] + 1 + ACTIONS.index(action))
+
+	_, path_x, path_y = ternary_layout(np.array(path))
+	ax.plot(path_x, path_y, color="red", linewidth=2, zorder=3)
+
+	ax.figure.colorbar(points, ax=ax, label="reward")
+	ax.set_xlim(0, 1)
+	ax.set_ylim(-time_horizon - .5, .5)
+	ax.set_yticks(range(0, -time_horizon - 1, -1), range(time_horizon + 1))
+	ax.set_ylabel("depth")
+	ax.set_xticks([])
+	if title is not None: ax.set_title(title)
+
+	return ax
+
+
 def bar_plot(ax, data, errors=None, title=None, colors=None, total_width=0.8, single_width=1, labels=None):
 	"""Draws a bar plot with multiple bars per data point."""
 	if title is not None:
@@ -192,14 +251,14 @@ def bar_plot(ax, data, errors=None, title=None, colors=None, total_width=0.8, si
 		for x, y in enumerate(values):
 			bar = ax.bar(x + x_offset, y, width=bar_width * single_width, color=colors[i % len(colors)])
 			if errors and errors[name][x] != 0:
-				plt.errorbar(x + x_offset, y, yerr=errors[name][x], color="black", capsize=4)
+				ax.errorbar(x + x_offset, y, yerr=errors[name][x], color="black", capsize=4)
 		bars.append(bar[0])
 		
 
 	ax.legend(bars, data.keys())
 
 	if labels is not None:
-		plt.xticks(range(len(labels)), labels)
+		ax.set_xticks(range(len(labels)), labels)
 
 def stacked_bar_plot(ax, data, title=None, labels=None):
 	if title is not None:
@@ -222,4 +281,4 @@ def stacked_bar_plot(ax, data, title=None, labels=None):
 		bars.append(bar[0])
 
 	ax.legend(bars, [Action(value).name for value in data[0].keys()])
-	plt.xticks(range(time_horizon))
\ No newline at end of file
+	ax.set_xticks(range(time_horizon))
\ No newline at end of file
@@ -0,0 +1,104 @@
+from tree_traversal import level_order
+
+import numpy as np
+import random, math
+
+MODES = ("full", "sampled", "deferred", "off")
+
+
+class RewardMismatch(AssertionError):
+	"""Raised when the reward of some nodes differs from cash + inventory * price"""
+
+	def __init__(self, mismatches: list[tuple[float, float]]):
+		super().__init__("rewards mismatch", mismatches)
+		self.mismatches = mismatches
+
+
+class ValidationPolicy:
+	"""
+		Decides when to run the safety check on the reward of the nodes, with
+		the same tolerance as math.isclose. In "full" mode every node is
+		checked as it is created; in "sampled" mode only the trees multiple of
+		every are checked, and in those only the given fraction of the nodes;
+		in "deferred" mode whole trees are checked at once after being built,
+		reporting every mismatch; in "off" mode nothing is checked.
+	"""
+
+	def __init__(self, mode = "full", every = 1, fraction = 1., seed = None):
+		assert mode in MODES, ("unknown validation mode", mode)
+		self.mode = mode
+		self.every = every
+		self.fraction = fraction
+		self.seed = seed
+		self.random = random.Random(seed)
+
+		self.trees = 0
+		self.checks = 0
+		self.mismatches = 0
+
+		self.active = mode != "off"
+		self.pending = []
+
+	@property
+	def deferred(self):
+		return self.mode == "deferred" and self.active
+
+	def begin_tree(self):
+		"""Signal that a new tree is being built"""
+		self.active = self.mode != "off" and (self.mode != "sampled" or self.trees % self.every == 0)
+		self.trees += 1
+
+	def sample(self) -> bool:
+		"""Whether the node being created should be checked right away"""
+		if self.mode == "full": return True
+		if self.mode != "sampled" or not self.active: return False
+		return self.fraction >= 1 or self.random.random() < self.fraction
+
+	def check(self, reward, cash, inventory, price):
+		"""Check a single node"""
+		self.checks += 1
+		if not math.isclose(reward, cash + inventory * price):
+			self.mismatches += 1
+			raise RewardMismatch([(reward, cash + inventory * price)])
+
+	def defer(self, reward, cash, inventory, price):
+		"""Store a node to be checked when the tree is complete"""
+		self.pending.append((reward, cash, inventory, price))
+
+	def end_tree(self, root = None):
+		"""In deferred mode, check all the nodes of the tree and the stored ones"""
+		if not self.deferred: return
+
+		states = self.pending
+		if root is not None:
+			states += [(node.reward, node.cash, node.inventory, node.price) for node in level_order(root, unique=True)]
+		self.pending = []
+
+		if len(states) > 0:
+			self.check_arrays(*np.array(states, dtype=float).T)
+
+	def check_arrays(self, reward, cash, inventory, price, valid = True):
+		"""Check many nodes at once, reporting all the mismatches among the valid ones"""
+		if not self.active: return
+
+		expected = cash + inventory * price
+		valid = np.broadcast_to(valid, np.shape(reward))
+		wrong = valid & ~np.isclose(reward, expected, rtol=1e-9, atol=0)
+
+		self.checks += int(valid.sum())
+		self.mismatches += int(wrong.sum())
+		if wrong.any():
+			raise RewardMismatch(list(zip(reward[wrong].tolist(), expected[wrong].tolist())))
+
+	def fresh(self):
+		"""Policy with the same settings and zeroed counters, to hand to another process and merge back"""
+		return ValidationPolicy(self.mode, self.every, self.fraction, self.seed)
+
+	def merge(self, other):
+		"""Add the counters of a policy used elsewhere, for example by another process"""
+		self.trees += other.trees
+		self.checks += other.checks
+		self.mismatches += other.mismatches
+
+	def __str__(self):
+		return f"{self.mode}: trees {self.trees}, checks {self.checks}, mismatches {self.mismatches}"
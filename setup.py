@@ -7,5 +7,6 @@ setup(
    author="Luigi Foscari",
    author_email="luigi.foscari@unimi.it",
    packages=["madtree"],
-   install_requires=["networkx", "pygraphviz", "matplotlib"],
+   install_requires=["numpy", "tqdm"],
+   extras_require={"plot": ["networkx", "pygraphviz", "matplotlib"]},
 )
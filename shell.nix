@@ -3,6 +3,7 @@ let
 in pkgs.mkShell {
   packages = [
     (pkgs.python3.withPackages (python-pkgs: [
+      python-pkgs.numpy
       python-pkgs.networkx
       python-pkgs.pygraphviz
       python-pkgs.matplotlib